@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 """Main run script."""
 import gc
+import os
 import sys
 import uuid
 import json
@@ -96,6 +97,21 @@ def get_parser():
         help="Path to existing directory containing BIDS "
         "Database files useful for speeding up run-time.",
     )
+    g_bids.add_argument(
+        "--reset-database",
+        action="store_true",
+        default=False,
+        help="Index the whole dataset again instead of only the subjects whose "
+        "files changed since the database in the working directory was built.",
+    )
+    g_bids.add_argument(
+        "--index-procs",
+        action="store",
+        type=int,
+        default=None,
+        help="Number of processes indexing subjects in parallel "
+        "(default: number of available CPUs).",
+    )
 
     g_prep = parser.add_argument_group("Options for preprocessing data")
     g_prep.add_argument(
@@ -108,8 +124,9 @@ def get_parser():
             "Smooth BOLD series with FWHM mm kernel prior to fitting. "
             "Optional analysis LEVEL (default: l1) is specified by level "
             "(`l1`) or name (`run`, `subject`, `session` or `dataset`). "
-            "Optional smoothing TYPE (default: iso) must be one of:"
-            "`iso` (isotropic). "
+            "Optional smoothing TYPE (default: iso) must be one of: "
+            "`iso` (isotropic Gaussian), `susan` (FSL SUSAN) "
+            "or `inp` (in-plane FSL SUSAN). "
             "e.g., `--smoothing 5:run:iso` will perform a 5mm FWHM isotropic "
             "smoothing on run-level maps before evaluating the dataset level."
         ),
@@ -155,6 +172,36 @@ def get_parser():
         default=None,
         help="File containing plugin configuration for Nipype.",
     )
+    g_perf.add_argument(
+        "--engine",
+        action="store",
+        default="fsl",
+        choices=["fsl", "native"],
+        help="Backend used for model estimation. `native` fits models in process "
+        "with NumPy instead of calling FSL binaries.",
+    )
+    g_perf.add_argument(
+        "--gzip-level",
+        action="store",
+        type=int,
+        choices=range(1, 10),
+        default=None,
+        help="Compression level of gzipped images written by funcworks (default: 1).",
+    )
+    g_perf.add_argument(
+        "--gzip-threads",
+        action="store",
+        type=int,
+        default=None,
+        help="Number of threads compressing each gzipped image (default: up to 4).",
+    )
+    g_perf.add_argument(
+        "--uncompressed-work",
+        action="store_true",
+        default=False,
+        help="Write intermediate images uncompressed (.nii) in the working directory, "
+        "only images copied to the output directory are gzipped.",
+    )
     g_perf.add_argument(
         "--resource-monitor",
         dest="resource_monitor",
@@ -167,6 +214,7 @@ def get_parser():
 def main():
     """Entry Point."""
     from multiprocessing import set_start_method, Process, Manager
+    from ..utils.compression import GZIP_LEVEL_VAR, GZIP_THREADS_VAR
 
     set_start_method("spawn")
     warnings.showwarning = _warn_redirect
@@ -174,6 +222,12 @@ def main():
     opts = get_parser().parse_args()
     # exec_env = os.name
 
+    # Read by every process that writes images, including workflow nodes
+    if opts.gzip_level is not None:
+        os.environ[GZIP_LEVEL_VAR] = str(opts.gzip_level)
+    if opts.gzip_threads is not None:
+        os.environ[GZIP_THREADS_VAR] = str(opts.gzip_threads)
+
     # sentry_sdk = None
     #
     # if not opts.notrack:
@@ -251,10 +305,12 @@ def build_workflow(opts, retval):
     ``multiprocessing.Process`` that allows funcworks to enforce
     a hard-limited memory-scope.
     """
+    from multiprocessing import cpu_count
     from bids import BIDSLayout
 
     from nipype import logging as nlogging, config as ncfg
     from ..workflows.base import init_funcworks_wf
+    from ..utils import index_layout, write_manifest
     from .. import __version__
 
     build_log = nlogging.getLogger("nipype.workflow")
@@ -270,12 +326,13 @@ def build_workflow(opts, retval):
 
     if not opts.database_path:
         database_path = str(opts.work_dir.resolve() / "dbcache")
-        layout = BIDSLayout(
+        layout = index_layout(
             bids_dir,
+            database_path,
             derivatives=opts.derivatives,
-            validate=True,
-            database_file=database_path,
-            reset_database=True,
+            participants=opts.participant_label,
+            reset_database=opts.reset_database,
+            n_procs=opts.index_procs or cpu_count(),
         )
     else:
         database_path = opts.database_path
@@ -394,6 +451,23 @@ def build_workflow(opts, retval):
     else:
         model_file = opts.model_file
 
+    # Resolve the inputs of every participant once, so func_select nodes can
+    # skip the database at execution time.
+    with open(model_file, "r") as read_mdl:
+        include_entities = json.load(read_mdl).get("Input", {}).get("Include", {})
+    manifest_dir = Path(work_dir) / "manifests"
+    manifests = {}
+    for subject_id in retval["participant_label"]:
+        try:
+            manifests[subject_id] = write_manifest(
+                layout,
+                {**include_entities, "subject": subject_id},
+                manifest_dir / f"sub-{subject_id}_manifest.json",
+                align_volumes=opts.align_volumes,
+            )
+        except (FileNotFoundError, ValueError) as e:
+            build_log.warning(f"No input manifest for sub-{subject_id}: {e}")
+
     retval["workflow"] = init_funcworks_wf(
         model_file=model_file,
         bids_dir=opts.bids_dir,
@@ -409,6 +483,9 @@ def build_workflow(opts, retval):
         align_volumes=opts.align_volumes,
         smooth_autocorrelations=opts.smooth_autocorrelations,
         despike=opts.despike,
+        engine=opts.engine,
+        manifests=manifests,
+        uncompressed_work=opts.uncompressed_work,
     )
 
     retval["return_code"] = 0
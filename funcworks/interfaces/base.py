@@ -0,0 +1,10 @@
+"""Input specifications shared by funcworks interfaces."""
+from nipype.interfaces.base import BaseInterfaceInputSpec, traits
+
+
+class OutputTypeInputSpec(BaseInterfaceInputSpec):
+    """Inputs of interfaces writing images, named like those of nipype's FSL interfaces."""
+
+    output_type = traits.Enum(
+        "NIFTI_GZ", "NIFTI", usedefault=True, desc="Format of the images written by the interface"
+    )
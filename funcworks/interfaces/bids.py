@@ -19,9 +19,19 @@ from nipype.interfaces.base import (
 )
 from nipype.interfaces.io import IOBase
 import nibabel as nb
-from ..utils import snake_to_camel
+from ..utils import (
+    snake_to_camel,
+    load_layout,
+    collect_run_files,
+    open_image_file,
+    save_image,
+    convert_nifti,
+    build_bids_path,
+)
 
 iflogger = logging.getLogger("nipype.interface")
+# Extensions of single file and paired NIfTI images
+_NIFTI_EXTENSIONS = (".nii", ".nii.gz", ".hdr", ".img")
 
 
 def bids_split_filename(fname):
@@ -109,8 +119,6 @@ class BIDSDataSink(IOBase):
     _always_run = True
 
     def _list_outputs(self):
-        from bids.layout.writing import build_path
-
         base_dir = Path(self.inputs.base_directory)
         base_dir.mkdir(exist_ok=True, parents=True)  # pylint: disable=E1123
 
@@ -125,7 +133,7 @@ class BIDSDataSink(IOBase):
 
             ents = {k: snake_to_camel(str(v)) for k, v in ents.items()}
 
-            out_fname = base_dir / build_path(ents, path_patterns)
+            out_fname = base_dir / build_bids_path(ents, path_patterns)
             out_fname.parent.mkdir(exist_ok=True, parents=True)
 
             _copy_or_convert(in_file, out_fname)
@@ -146,21 +154,30 @@ def _copy_or_convert(in_file, out_file):
     # gzip/gunzip if it's easy
     if in_ext == out_ext + ".gz" or in_ext + ".gz" == out_ext:
         read_open = GzipFile if in_ext.endswith(".gz") else open
-        write_open = GzipFile if out_ext.endswith(".gz") else open
         with read_open(in_file, mode="rb") as in_fobj:
-            with write_open(out_file, mode="wb") as out_fobj:
-                shutil.copyfileobj(in_fobj, out_fobj)
+            with open_image_file(out_file) as out_fobj:
+                shutil.copyfileobj(in_fobj, out_fobj, length=4 << 20)
         return
 
-    # Let nibabel take a shot
     try:
-        nb.save(nb.load(in_file), out_file)
-    except Exception:
-        pass
-    else:
+        image = nb.load(in_file)
+    except Exception as err:
+        raise RuntimeError(
+            f"Cannot convert {in_ext} to {out_ext}, unable to read {in_file}"
+        ) from err
+
+    # Switch between single file and paired NIfTI layouts without decoding the data
+    if isinstance(image, nb.Nifti1Pair) and out_ext in _NIFTI_EXTENSIONS:
+        convert_nifti(image, out_file)
         return
 
-    raise RuntimeError(f"Cannot convert {in_ext} to {out_ext}")
+    # Let nibabel take a shot
+    try:
+        save_image(image, out_file)
+    except Exception as err:
+        raise RuntimeError(
+            f"Cannot convert {in_ext} to {out_ext}, unable to write {in_file} to {out_file}"
+        ) from err
 
 
 class _BIDSGetInputSpec(BaseInterfaceInputSpec):
@@ -169,6 +186,9 @@ class _BIDSGetInputSpec(BaseInterfaceInputSpec):
     align_volumes = traits.Either(
         traits.Int, None, default=None, desc="Run reference to align functional volumes",
     )
+    manifest_file = File(
+        exists=True, desc="Files resolved at build time, used instead of the database if current"
+    )
 
 
 class _BIDSGetOutputSpec(TraitedSpec):
@@ -190,90 +210,27 @@ class BIDSGet(SimpleInterface):
     _pkg = "bids"
 
     def _run_interface(self, runtime):
-        from bids import BIDSLayout
-
-        layout = BIDSLayout.load(database_path=self.inputs.database_path)
         fixed_entities = self.inputs.fixed_entities
-
-        functional_entities = {
-            **fixed_entities,
-            "datatype": "func",
-            "desc": "preproc",
-            "extension": "nii.gz",
-            "suffix": "bold",
-        }
-        functional_files = layout.get(**functional_entities)
-        if len(functional_files) == 0:
-            raise FileNotFoundError(
-                f"Unable to find functional image with "
-                f"specified entities {functional_entities}"
+        align_volumes = self.inputs.align_volumes if isdefined(self.inputs.align_volumes) else None
+        run_files = None
+        if isdefined(self.inputs.manifest_file):
+            manifest = json.loads(Path(self.inputs.manifest_file).read_text())
+            if (
+                manifest.pop("fixed_entities") == fixed_entities
+                and manifest.pop("align_volumes") == align_volumes
+            ):
+                run_files = manifest
+            else:
+                iflogger.warning(
+                    f"{self.inputs.manifest_file} was written for another query, "
+                    f"querying {self.inputs.database_path} instead"
+                )
+        if run_files is None:
+            run_files = collect_run_files(
+                load_layout(self.inputs.database_path), fixed_entities, align_volumes=align_volumes
             )
 
-        outputs = dict(
-            mask_files=[],
-            reference_files=[],
-            events_files=[],
-            metadata_files=[],
-            regressor_files=[],
-            entities=[],
-        )
-
-        for file in functional_files:
-            ents = layout.parse_file_entities(file.path)
-            if "space" not in ents:
-                ents["space"] = None
-            file_ents = dict(
-                events={
-                    **ents,
-                    "desc": None,
-                    "extension": "tsv",
-                    "suffix": "events",
-                    "space": None,
-                },
-                metadata={**ents, "extension": "json"},
-                regressor={
-                    **ents,
-                    "desc": "confounds",
-                    "space": None,
-                    "suffix": "regressors",
-                    "extension": "tsv",
-                },
-                mask={**ents, "desc": "brain", "suffix": "mask"},
-                reference={**ents, "suffix": "boldref", "desc": None},
-            )
-            if self.inputs.align_volumes and "run" not in ents:
-                raise ValueError(
-                    f"Attempted to align to when run entity is not present in " f"{file.path}."
-                )
-            elif self.inputs.align_volumes:
-                file_ents["mask"]["run"] = self.inputs.align_volumes
-                file_ents["reference"]["run"] = self.inputs.align_volumes
-
-            ents.pop("suffix", None)
-            ents.pop("desc", None)
-            outputs["entities"].append(ents)
-            for filetype, entities in file_ents.items():
-                files = layout.get(**entities)
-                if len(files) > 1:
-                    raise ValueError(
-                        f"More than one {filetype} produced for given "
-                        f"entities {entities}\n"
-                        f"{[x.path for x in files]}"
-                        f"{ents}"
-                    )
-                elif len(files) == 0:
-                    raise FileNotFoundError(
-                        f"No {filetype} found for given entities " f"{entities}"
-                    )
-                else:
-                    outputs[f"{filetype}_files"].append(files[0])
-
-        self._results["functional_files"] = functional_files
-        self._results["mask_files"] = outputs["mask_files"]
-        self._results["reference_files"] = outputs["reference_files"]
-        self._results["metadata_files"] = outputs["metadata_files"]
-        self._results["events_files"] = outputs["events_files"]
-        self._results["regressor_files"] = outputs["regressor_files"]
-        self._results["entities"] = outputs["entities"]
+        for output, files in run_files.items():
+            self._results[output] = files
 
         return runtime
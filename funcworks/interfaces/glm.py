@@ -0,0 +1,396 @@
+"""Native interfaces for estimating models without calling FSL binaries."""
+from functools import partial
+from pathlib import Path
+from nipype.interfaces.base import (
+    TraitedSpec,
+    InputMultiPath,
+    OutputMultiPath,
+    File,
+    traits,
+    isdefined,
+    SimpleInterface,
+)
+import nibabel as nb
+import numpy as np
+from .base import OutputTypeInputSpec
+from ..utils import (
+    OUTPUT_EXTENSIONS,
+    load_timeseries,
+    save_masked,
+    save_image,
+    smooth_in_mask,
+    read_vest,
+    t_to_z,
+    z_to_p,
+)
+
+
+class _EstimateRunModelInputSpec(OutputTypeInputSpec):
+    in_file = File(
+        exists=True,
+        mandatory=True,
+        desc="Masked 4D BOLD series or (timepoints x voxels) .npy matrix from MaskTimeseries",
+    )
+    mask_file = File(
+        exists=True,
+        desc="Brain mask, nonzero voxels of in_file are used if not given. "
+        "Required for .npy inputs",
+    )
+    design_file = File(exists=True, mandatory=True, desc="FSL design matrix (.mat)")
+    tcon_file = File(exists=True, mandatory=True, desc="FSL t-contrast matrix (.con)")
+    results_dir = traits.Str("results", usedefault=True, desc="Directory to store results in")
+    block_size = traits.Int(
+        50000, usedefault=True, desc="Number of voxels estimated together to bound memory"
+    )
+    autocorr_model = traits.Enum(
+        "none",
+        "tukey",
+        "ar1",
+        usedefault=True,
+        desc="Voxelwise autocorrelation model used to prewhiten data and design",
+    )
+    tukey_window = traits.Int(desc="Tukey taper size, defaults to sqrt(timepoints)")
+    smooth_autocorr = traits.Bool(
+        False, usedefault=True, desc="Spatially smooth autocorrelation estimates within the mask"
+    )
+    autocorr_fwhm = traits.Float(
+        5.0, usedefault=True, desc="FWHM in mm of the autocorrelation smoothing kernel"
+    )
+
+
+class _EstimateRunModelOutputSpec(TraitedSpec):
+    copes = OutputMultiPath(File(exists=True), desc="Contrast estimates for each contrast")
+    varcopes = OutputMultiPath(File(exists=True), desc="Variance estimates for each contrast")
+    tstats = OutputMultiPath(File(exists=True), desc="t-statistic images for each contrast")
+    zstats = OutputMultiPath(File(exists=True), desc="z-statistic images for each contrast")
+    pvals = OutputMultiPath(File(exists=True), desc="p-value images for each contrast")
+    dof_file = File(exists=True, desc="Degrees of freedom of the model")
+
+
+class EstimateRunModel(SimpleInterface):
+    """
+    Estimate a run level GLM in process with ordinary least squares.
+
+    Serves as a drop in replacement for FSL's FILMGLS. The timeseries is read
+    once, demeaned like FILM does, and the pseudo-inverse of the design is
+    applied to blocks of voxels at a time. When ``autocorr_model`` is set,
+    residual autocorrelation is estimated per voxel (Tukey tapered FFT estimate
+    or Yule-Walker AR(1)), optionally smoothed within the mask, and data and
+    design are prewhitened blockwise before a second, voxelwise fit. Outputs
+    follow FILMGLS' ``results/cope1.nii.gz`` naming, p-value maps are computed
+    from the in-memory z statistics as well.
+    """
+
+    input_spec = _EstimateRunModelInputSpec
+    output_spec = _EstimateRunModelOutputSpec
+
+    def _run_interface(self, runtime):
+        design, _ = read_vest(self.inputs.design_file)
+        contrasts, _ = read_vest(self.inputs.tcon_file)
+        mask_file = self.inputs.mask_file if isdefined(self.inputs.mask_file) else None
+        timeseries, mask, reference = load_timeseries(self.inputs.in_file, mask_file)
+        if timeseries.shape[0] != design.shape[0]:
+            raise ValueError(
+                f"Design matrix has {design.shape[0]} rows but "
+                f"{self.inputs.in_file} has {timeseries.shape[0]} timepoints"
+            )
+
+        if self.inputs.autocorr_model == "none":
+            copes, varcopes, dof = _fit_ols(
+                timeseries, design, contrasts, block_size=self.inputs.block_size
+            )
+        else:
+            tukey_window = self.inputs.tukey_window
+            if not isdefined(tukey_window):
+                tukey_window = int(np.sqrt(design.shape[0]))
+            smooth_autocorr = None
+            if self.inputs.smooth_autocorr:
+                smooth_autocorr = partial(
+                    smooth_in_mask,
+                    mask=mask,
+                    zooms=reference.header.get_zooms()[:3],
+                    fwhm=self.inputs.autocorr_fwhm,
+                )
+            copes, varcopes, dof = _fit_prewhitened(
+                timeseries,
+                design,
+                contrasts,
+                autocorr_model=self.inputs.autocorr_model,
+                tukey_window=tukey_window,
+                block_size=self.inputs.block_size,
+                smooth_autocorr=smooth_autocorr,
+            )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tstats = np.where(varcopes > 0, copes / np.sqrt(varcopes), 0)
+        zstats = t_to_z(tstats, dof)
+
+        results_dir = Path(runtime.cwd) / self.inputs.results_dir
+        results_dir.mkdir(exist_ok=True, parents=True)
+        extension = OUTPUT_EXTENSIONS[self.inputs.output_type]
+        # Outside the mask z is 0, which fslmaths -ztop maps to p = 0.5
+        for name, maps in [
+            ("copes", copes),
+            ("varcopes", varcopes),
+            ("tstats", tstats),
+            ("zstats", zstats),
+            ("pvals", z_to_p(zstats)),
+        ]:
+            self._results[name] = [
+                save_masked(
+                    stat_map,
+                    mask,
+                    reference,
+                    str(results_dir / f"{name[:-1]}{i}{extension}"),
+                    fill=0.5 if name == "pvals" else 0.0,
+                )
+                for i, stat_map in enumerate(maps, start=1)
+            ]
+        dof_file = results_dir / "dof"
+        dof_file.write_text(f"{dof}\n")
+        self._results["dof_file"] = str(dof_file)
+
+        return runtime
+
+
+class _EstimateFixedEffectsInputSpec(OutputTypeInputSpec):
+    effect_maps = InputMultiPath(File(exists=True), mandatory=True, desc="Lower level copes")
+    variance_maps = InputMultiPath(
+        File(exists=True), mandatory=True, desc="Lower level varcopes, ordered as effect_maps"
+    )
+    dof_values = traits.List(
+        traits.Float, mandatory=True, desc="Degrees of freedom of each lower level map"
+    )
+    mask_file = File(exists=True, desc="Brain mask restricting estimation")
+
+
+class _EstimateFixedEffectsOutputSpec(TraitedSpec):
+    copes = File(exists=True, desc="Fixed effects contrast estimate")
+    var_copes = File(exists=True, desc="Fixed effects variance estimate")
+    tstats = File(exists=True, desc="Fixed effects t-statistic")
+    zstats = File(exists=True, desc="Fixed effects z-statistic")
+    pvals = File(exists=True, desc="Fixed effects p-values")
+
+
+class EstimateFixedEffects(SimpleInterface):
+    """
+    Combine lower level maps with an inverse-variance weighted fixed effects model.
+
+    Equivalent to FLAMEO's ``run_mode="fe"`` with a single group mean regressor,
+    the result has the summed degrees of freedom of its inputs. Maps are
+    accumulated one at a time instead of being merged into a 4D image first.
+    """
+
+    input_spec = _EstimateFixedEffectsInputSpec
+    output_spec = _EstimateFixedEffectsOutputSpec
+
+    def _run_interface(self, runtime):
+        if len(self.inputs.effect_maps) != len(self.inputs.variance_maps):
+            raise ValueError("Number of effect and variance maps must match")
+        if len(self.inputs.effect_maps) != len(self.inputs.dof_values):
+            raise ValueError("A degrees of freedom value is required for every effect map")
+
+        reference = nb.load(self.inputs.effect_maps[0])
+        if isdefined(self.inputs.mask_file):
+            mask = np.asanyarray(nb.load(self.inputs.mask_file).dataobj) > 0
+        else:
+            mask = np.ones(reference.shape[:3], dtype=bool)
+
+        weight_sum = np.zeros(mask.sum())
+        weighted_effects = np.zeros(mask.sum())
+        for effect_file, variance_file in zip(self.inputs.effect_maps, self.inputs.variance_maps):
+            variance = nb.load(variance_file).get_fdata()[mask]
+            with np.errstate(divide="ignore"):
+                weights = np.where(variance > 0, 1 / variance, 0)
+            weight_sum += weights
+            weighted_effects += weights * nb.load(effect_file).get_fdata()[mask]
+
+        estimable = weight_sum > 0
+        copes = np.zeros_like(weight_sum)
+        varcopes = np.zeros_like(weight_sum)
+        copes[estimable] = weighted_effects[estimable] / weight_sum[estimable]
+        varcopes[estimable] = 1 / weight_sum[estimable]
+        tstats = np.zeros_like(weight_sum)
+        tstats[estimable] = copes[estimable] / np.sqrt(varcopes[estimable])
+        zstats = t_to_z(tstats, sum(self.inputs.dof_values))
+
+        out_dir = Path(runtime.cwd) / "stats"
+        out_dir.mkdir(exist_ok=True, parents=True)
+        extension = OUTPUT_EXTENSIONS[self.inputs.output_type]
+        for name, stat_map in [
+            ("copes", copes),
+            ("var_copes", varcopes),
+            ("tstats", tstats),
+            ("zstats", zstats),
+            ("pvals", z_to_p(zstats)),
+        ]:
+            self._results[name] = save_masked(
+                stat_map,
+                mask,
+                reference,
+                str(out_dir / f"{name[:-1].replace('_', '')}1{extension}"),
+                fill=0.5 if name == "pvals" else 0.0,
+            )
+
+        return runtime
+
+
+class _ConvertZToPInputSpec(OutputTypeInputSpec):
+    in_files = traits.List(File(exists=True), mandatory=True, desc="z-statistic images")
+
+
+class _ConvertZToPOutputSpec(TraitedSpec):
+    out_files = traits.List(File(exists=True), desc="p-value images, ordered as in_files")
+
+
+class ConvertZToP(SimpleInterface):
+    """Convert a list of z-statistic images to p-values in a single process."""
+
+    input_spec = _ConvertZToPInputSpec
+    output_spec = _ConvertZToPOutputSpec
+
+    def _run_interface(self, runtime):
+        self._results["out_files"] = []
+        extension = OUTPUT_EXTENSIONS[self.inputs.output_type]
+        for idx, in_file in enumerate(self.inputs.in_files):
+            z_image = nb.load(in_file)
+            p_data = z_to_p(z_image.get_fdata(dtype=np.float32)).astype(np.float32)
+            base = Path(in_file).name.split(".")[0]
+            out_file = str(Path(runtime.cwd) / f"{idx:03d}_{base}_pval{extension}")
+            save_image(nb.Nifti1Image(p_data, z_image.affine, z_image.header), out_file)
+            self._results["out_files"].append(out_file)
+
+        return runtime
+
+
+def _get_dof(design):
+    dof = design.shape[0] - np.linalg.matrix_rank(design)
+    if dof < 1:
+        raise ValueError(f"Design with {design.shape[1]} columns leaves no degrees of freedom")
+    return dof
+
+
+def _fit_ols(timeseries, design, contrasts, block_size=50000):
+    """Return copes, varcopes and degrees of freedom for (time x voxel) data."""
+    pinv_design = np.linalg.pinv(design)
+    dof = _get_dof(design)
+    contrast_var = np.einsum("ij,jk,ik->i", contrasts, pinv_design @ pinv_design.T, contrasts)
+
+    n_voxels = timeseries.shape[1]
+    copes = np.zeros((len(contrasts), n_voxels), dtype=np.float32)
+    varcopes = np.zeros((len(contrasts), n_voxels), dtype=np.float32)
+    for start in range(0, n_voxels, block_size):
+        block = timeseries[:, start : start + block_size].astype(np.float64)
+        block -= block.mean(axis=0)
+        betas = pinv_design @ block
+        residuals = block - design @ betas
+        sigma_squared = np.einsum("ij,ij->j", residuals, residuals) / dof
+        copes[:, start : start + block_size] = contrasts @ betas
+        varcopes[:, start : start + block_size] = np.outer(contrast_var, sigma_squared)
+    return copes, varcopes, dof
+
+
+def _fit_prewhitened(
+    timeseries,
+    design,
+    contrasts,
+    autocorr_model="tukey",
+    tukey_window=None,
+    block_size=50000,
+    smooth_autocorr=None,
+):
+    """
+    Return copes, varcopes and degrees of freedom after voxelwise prewhitening.
+
+    Autocorrelation is estimated for every voxel from OLS residuals first, so
+    ``smooth_autocorr`` (a callable taking and returning a lags x voxels array)
+    can regularise the estimates spatially before data and design are whitened.
+    """
+    n_timepoints, n_regressors = design.shape
+    pinv_design = np.linalg.pinv(design)
+    dof = _get_dof(design)
+    n_fft = 2 ** int(np.ceil(np.log2(2 * n_timepoints)))
+    n_lags = 2 if autocorr_model == "ar1" else tukey_window
+
+    n_voxels = timeseries.shape[1]
+    autocorr = np.zeros((n_lags, n_voxels))
+    for start in range(0, n_voxels, block_size):
+        block = timeseries[:, start : start + block_size].astype(np.float64)
+        block -= block.mean(axis=0)
+        residuals = block - design @ (pinv_design @ block)
+        autocorr[:, start : start + block_size] = _estimate_autocorr(residuals, n_fft)[:n_lags]
+    if smooth_autocorr is not None:
+        autocorr[1:] = smooth_autocorr(autocorr[1:])
+
+    design_fft = np.fft.rfft(design, n=n_fft, axis=0)
+    # Whitened designs are voxel specific, keep (voxels x time x regressors) chunks small
+    chunk_size = min(block_size, max(1, 2 ** 22 // (n_fft * n_regressors)))
+    copes = np.zeros((len(contrasts), n_voxels), dtype=np.float32)
+    varcopes = np.zeros((len(contrasts), n_voxels), dtype=np.float32)
+    for start in range(0, n_voxels, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        data = timeseries[:, chunk].astype(np.float64)
+        data -= data.mean(axis=0)
+        if autocorr_model == "ar1":
+            white_data, white_design = _whiten_ar1(data, design, autocorr[1, chunk])
+        else:
+            white_data, white_design = _whiten_tukey(
+                data, design_fft, autocorr[:, chunk], tukey_window, n_fft
+            )
+        copes[:, chunk], varcopes[:, chunk] = _fit_voxelwise(
+            white_data, white_design, contrasts, dof
+        )
+    return copes, varcopes, dof
+
+
+def _estimate_autocorr(residuals, n_fft):
+    """Biased autocorrelation estimate of each column via the power spectrum."""
+    n_timepoints = residuals.shape[0]
+    spectrum = np.fft.rfft(residuals, n=n_fft, axis=0)
+    autocov = np.fft.irfft(np.abs(spectrum) ** 2, n=n_fft, axis=0)[:n_timepoints]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        autocorr = np.where(autocov[0] > 0, autocov / autocov[0], 0)
+    autocorr[0] = 1
+    return autocorr
+
+
+def _whiten_tukey(data, design_fft, autocorr, tukey_window, n_fft):
+    """Prewhiten data and design with Tukey tapered autocorrelation estimates."""
+    n_timepoints = data.shape[0]
+    lags = np.arange(tukey_window)
+    taper = 0.5 * (1 + np.cos(np.pi * lags / tukey_window))
+    kernel = np.zeros((n_fft, data.shape[1]))
+    kernel[:tukey_window] = autocorr[:tukey_window] * taper[:, np.newaxis]
+    kernel[n_fft - tukey_window + 1 :] = kernel[1:tukey_window][::-1]
+    power = np.fft.rfft(kernel, axis=0).real
+    whitening_filter = 1 / np.sqrt(np.clip(power, 1e-6, None))
+
+    white_data = np.fft.irfft(
+        np.fft.rfft(data, n=n_fft, axis=0) * whitening_filter, n=n_fft, axis=0
+    )[:n_timepoints].T
+    white_design = np.fft.irfft(
+        design_fft[np.newaxis] * whitening_filter.T[:, :, np.newaxis], n=n_fft, axis=1
+    )[:, :n_timepoints]
+    return white_data, white_design
+
+
+def _whiten_ar1(data, design, rho):
+    """Prewhiten data and design with voxelwise Yule-Walker AR(1) estimates."""
+    rho = np.clip(rho, -0.99, 0.99)
+    white_data = data.T.copy()
+    white_data[:, 1:] -= rho[:, np.newaxis] * data[:-1].T
+    white_data[:, 0] *= np.sqrt(1 - rho ** 2)
+    white_design = np.repeat(design[np.newaxis], len(rho), axis=0)
+    white_design[:, 1:] -= rho[:, np.newaxis, np.newaxis] * design[np.newaxis, :-1]
+    white_design[:, 0] *= np.sqrt(1 - rho ** 2)[:, np.newaxis]
+    return white_data, white_design
+
+
+def _fit_voxelwise(white_data, white_design, contrasts, dof):
+    """Fit (voxels x time) data against (voxels x time x regressors) designs."""
+    cov = np.linalg.pinv(np.einsum("vtp,vtq->vpq", white_design, white_design), hermitian=True)
+    betas = np.einsum("vpq,vtq,vt->vp", cov, white_design, white_data, optimize=True)
+    residuals = white_data - np.einsum("vtp,vp->vt", white_design, betas)
+    sigma_squared = np.einsum("vt,vt->v", residuals, residuals) / dof
+    copes = contrasts @ betas.T
+    contrast_var = np.einsum("cp,vpq,cq->cv", contrasts, cov, contrasts)
+    return copes, contrast_var * sigma_squared
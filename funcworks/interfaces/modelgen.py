@@ -1,4 +1,5 @@
 """Interfaces for constructing models in FSL."""
+import hashlib
 from pathlib import Path
 from nipype.interfaces.base import (
     BaseInterfaceInputSpec,
@@ -9,11 +10,26 @@ from nipype.interfaces.base import (
     File,
     traits,
     Directory,
+    isdefined,
 )
 from nipype.interfaces.io import IOBase
+from nipype import logging
 import nibabel as nb
 import numpy as np
-from ..utils import snake_to_camel
+from .base import OutputTypeInputSpec
+from ..utils import (
+    OUTPUT_EXTENSIONS,
+    snake_to_camel,
+    image_shape,
+    write_volumes,
+    load_layout,
+    load_confounds,
+    build_bids_path,
+)
+
+iflogger = logging.getLogger("nipype.interface")
+# fMRIPrep motion confounds in the FSL order, rotations then translations
+_MOTION_COLUMNS = ["rot_x", "rot_y", "rot_z", "trans_x", "trans_y", "trans_z"]
 
 
 class _GetRunModelInfoInputSpec(BaseInterfaceInputSpec):
@@ -25,6 +41,9 @@ class _GetRunModelInfoInputSpec(BaseInterfaceInputSpec):
     detrend_poly = traits.Any(
         default=None, desc=("Legendre polynomials to regress out" "for temporal filtering"),
     )
+    cache_dir = Directory(
+        exists=True, nohash=True, desc="Folder caching confounds in columnar form"
+    )
 
 
 class _GetRunModelInfoOutputSpec(TraitedSpec):
@@ -50,12 +69,17 @@ class GetRunModelInfo(IOBase):
 
         outputs = {}
 
-        (outputs["motion_parameters"], n_timepoints,) = self._get_motion_parameters()
+        confound_data = self._load_confounds()
+        (outputs["motion_parameters"], n_timepoints,) = self._get_motion_parameters(
+            confound_data
+        )
 
         with open(self.inputs.metadata_file, "r") as meta_read:
             run_metadata = json.load(meta_read)
         outputs["repetition_time"] = run_metadata["RepetitionTime"]
-        (outputs["run_info"], event_regressors, confound_regressors,) = self._get_model_info()
+        (outputs["run_info"], event_regressors, confound_regressors,) = self._get_model_info(
+            confound_data
+        )
         (outputs["run_contrasts"], outputs["contrast_names"],) = self._get_contrasts(
             event_names=event_regressors
         )
@@ -66,21 +90,33 @@ class GetRunModelInfo(IOBase):
         )
 
         if self.inputs.detrend_poly:
-            polynomial_names, polynomial_arrays = self._detrend_polynomial()
+            polynomial_names, polynomial_arrays = self._detrend_polynomial(n_timepoints)
             outputs["run_info"].regressor_names.extend(polynomial_names)
             outputs["run_info"].regressors.extend(polynomial_arrays)
 
         return outputs
 
-    def _get_model_info(self):
-        import pandas as pd
+    def _load_confounds(self):
+        """Read only the confounds used by the model and the motion parameters."""
+        columns = set(_MOTION_COLUMNS) | {
+            regressor for regressor in self.inputs.model["Model"]["X"] if "." not in regressor
+        }
+        return load_confounds(
+            self.inputs.regressor_file,
+            columns,
+            cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None,
+        )
+
+    def _get_model_info(self, confound_data):
         import numpy as np
 
         level_model = self.inputs.model
 
-        event_data = pd.read_csv(self.inputs.events_file, sep="\t")
-        conf_data = pd.read_csv(self.inputs.regressor_file, sep="\t")
-        conf_data.fillna(0, inplace=True)
+        event_columns = {
+            regressor.split(".")[0] for regressor in level_model["Model"]["X"] if "." in regressor
+        }
+        events = _split_events(self.inputs.events_file, event_columns)
+        conf_data = confound_data.fillna(0)
 
         run_info = {
             "conditions": [],
@@ -93,13 +129,13 @@ class GetRunModelInfo(IOBase):
         for regressor in level_model["Model"]["X"]:
             if "." in regressor:
                 event_column, event_name = regressor.split(".")
-                event_frame = event_data.query(f'{event_column} == "{event_name}"')
-                if event_frame.empty:
+                if (event_column, event_name) not in events:
                     continue
+                onsets, durations = events[(event_column, event_name)]
                 run_info["conditions"].append(regressor)
-                run_info["onsets"].append(event_frame["onset"].values)
-                run_info["durations"].append(event_frame["duration"].values)
-                run_info["amplitudes"].append(np.ones(len(event_frame)))
+                run_info["onsets"].append(onsets)
+                run_info["durations"].append(durations)
+                run_info["amplitudes"].append(np.ones(len(onsets)))
             else:
                 run_info["regressor_names"].append(regressor)
                 run_info["regressors"].append(conf_data[regressor].values)
@@ -149,19 +185,17 @@ class GetRunModelInfo(IOBase):
                 )
         return contrast_spec, contrast_names
 
-    def _get_motion_parameters(self):
+    def _get_motion_parameters(self, confound_data):
         from pathlib import Path
-        import pandas as pd
 
         regressor_file = Path(self.inputs.regressor_file)
         motparams_path = str(regressor_file.name).replace("regressors", "motparams")
         motparams_path = Path.cwd() / motparams_path
 
-        confound_data = pd.read_csv(regressor_file, sep="\t")
         n_timepoints = len(confound_data)
         # Motion data gets formatted FSL style, with x, y, z rotation,
         # then x,y,z translation
-        motion_data = confound_data[["rot_x", "rot_y", "rot_z", "trans_x", "trans_y", "trans_z"]]
+        motion_data = confound_data[_MOTION_COLUMNS]
         motion_data.to_csv(motparams_path, sep="\t", header=None, index=None)
         motion_params = motparams_path
         return motion_params, n_timepoints
@@ -177,23 +211,283 @@ class GetRunModelInfo(IOBase):
             contrast_entities.append(run_entities.copy())
         return contrast_entities
 
-    def _detrend_polynomial(self):
+    def _detrend_polynomial(self, n_timepoints):
         import numpy as np
-        import pandas as pd
         from scipy.special import legendre
 
-        regressors_frame = pd.read_csv(self.inputs.regressor_file)
-
         poly_names = []
         poly_arrays = []
         for i in range(0, self.inputs.detrend_poly + 1):
             poly_names.append(f"legendre{i:02d}")
-            poly_arrays.append(legendre(i)(np.linspace(-1, 1, len(regressors_frame))))
+            poly_arrays.append(legendre(i)(np.linspace(-1, 1, n_timepoints)))
 
         return poly_names, poly_arrays
 
 
-class _GenerateHigherInfoInputSpec(BaseInterfaceInputSpec):
+def _split_events(events_file, columns):
+    """
+    Split an events table into onsets and durations per value of each column.
+
+    Every column is grouped in a single pass over the table.
+
+    Parameters
+    ----------
+    events_file : str
+        BIDS events TSV
+    columns : set
+        Columns whose (string) values define conditions
+    Returns
+    -------
+    events : dict
+        Maps ``(column, value)`` to an ``(onsets, durations)`` tuple of arrays
+    """
+    import pandas as pd
+
+    event_data = pd.read_csv(events_file, sep="\t")
+    onsets = event_data["onset"].values
+    durations = event_data["duration"].values
+    events = {}
+    for column in columns:
+        if column not in event_data:
+            raise KeyError(f"Column {column} referenced by the model is not in {events_file}")
+        for value, index in event_data.groupby(column, sort=False).indices.items():
+            # Conditions are matched as strings, like querying the column
+            if isinstance(value, str):
+                events[(column, value)] = (onsets[index], durations[index])
+    return events
+
+
+class _DetectOutliersInputSpec(BaseInterfaceInputSpec):
+    functional_file = File(exists=True, mandatory=True, desc="BOLD file the model is fit to")
+    mask_file = File(exists=True, mandatory=True, desc="Brain mask for global intensity")
+    regressor_file = File(exists=True, mandatory=True, desc="fMRIPrep confounds file")
+    run_info = traits.Any(mandatory=True, desc="Model Info required to construct Run Level Model")
+    contrast_entities = InputMultiPath(
+        traits.Dict(), mandatory=True, desc="Contrast entities that need updated DegreesOfFreedom"
+    )
+    fd_threshold = traits.Float(
+        1.0, usedefault=True, desc="Framewise displacement (mm) above which a volume is flagged"
+    )
+    zintensity_threshold = traits.Float(
+        3.0, usedefault=True, desc="Global intensity z-score above which a volume is flagged"
+    )
+    dvars_threshold = traits.Float(
+        desc="Standardized DVARS above which a volume is flagged, not used if undefined"
+    )
+    cache_dir = Directory(
+        exists=True, nohash=True, desc="Folder caching confounds in columnar form"
+    )
+
+
+class _DetectOutliersOutputSpec(TraitedSpec):
+    run_info = traits.Any(desc="Model Info with a regressor for every flagged volume")
+    contrast_entities = OutputMultiPath(
+        traits.Dict(), desc="Contrast entities with updated DegreesOfFreedom"
+    )
+    outlier_file = File(exists=True, desc="Indices of flagged volumes, one per line")
+
+
+class DetectOutliers(IOBase):
+    """
+    Flag outlier volumes and add spike regressors to the run model.
+
+    Replaces RapidArt and reshape_ra. Motion outliers come from the
+    ``framewise_displacement`` (and optionally ``std_dvars``) columns of the
+    fMRIPrep confounds, intensity outliers from the z-scored, linearly
+    detrended mean intensity within the brain mask. The BOLD series is read
+    once for both the global intensity and the number of volumes.
+    """
+
+    input_spec = _DetectOutliersInputSpec
+    output_spec = _DetectOutliersOutputSpec
+
+    def _list_outputs(self):
+        from scipy import signal
+
+        data = nb.load(self.inputs.functional_file).get_fdata(dtype=np.float32)
+        mask = np.asanyarray(nb.load(self.inputs.mask_file).dataobj) > 0
+        n_volumes = data.shape[3]
+        mean_intensity = np.nanmean(data[mask], axis=0)
+        del data
+        global_intensity = signal.detrend(mean_intensity)
+        # A constant signal has no intensity outliers, its residuals are rounding noise
+        intensity_z = np.zeros(n_volumes)
+        intensity_std = global_intensity.std()
+        if intensity_std > 1e-6 * np.abs(mean_intensity).mean():
+            intensity_z = (global_intensity - global_intensity.mean()) / intensity_std
+        outliers = np.abs(intensity_z) > self.inputs.zintensity_threshold
+
+        confounds = load_confounds(
+            self.inputs.regressor_file,
+            ["framewise_displacement", "std_dvars"],
+            cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None,
+        ).fillna(0)
+        required = ["framewise_displacement"]
+        if isdefined(self.inputs.dvars_threshold):
+            required.append("std_dvars")
+        for column in required:
+            if column not in confounds:
+                raise RuntimeError(
+                    f"Column {column} required to detect motion outliers "
+                    f"is not in {self.inputs.regressor_file}"
+                )
+        outliers |= confounds["framewise_displacement"].values > self.inputs.fd_threshold
+        if isdefined(self.inputs.dvars_threshold):
+            outliers |= confounds["std_dvars"].values > self.inputs.dvars_threshold
+        outlier_indices = np.flatnonzero(outliers)
+
+        outlier_file = Path.cwd() / "outliers.txt"
+        np.savetxt(outlier_file, outlier_indices, fmt="%d")
+
+        run_dict = self.inputs.run_info.dictcopy()
+        spikes = np.zeros((len(outlier_indices), n_volumes))
+        spikes[np.arange(len(outlier_indices)), outlier_indices] = 1
+        run_dict["regressor_names"] = list(run_dict["regressor_names"]) + [
+            f"rapidart{idx:02d}" for idx in range(len(outlier_indices))
+        ]
+        run_dict["regressors"] = list(run_dict["regressors"]) + list(spikes)
+
+        contrast_entities = []
+        for entities in self.inputs.contrast_entities:
+            entities = entities.copy()
+            entities["DegreesOfFreedom"] -= len(outlier_indices)
+            contrast_entities.append(entities)
+
+        return {
+            "run_info": Bunch(**run_dict),
+            "contrast_entities": contrast_entities,
+            "outlier_file": str(outlier_file),
+        }
+
+
+class _GenerateRunDesignInputSpec(BaseInterfaceInputSpec):
+    run_info = traits.Any(mandatory=True, desc="Model Info required to construct Run Level Model")
+    contrasts = traits.List(mandatory=True, desc="List of tuples describing each contrasts")
+    repetition_time = traits.Float(mandatory=True, desc="Repetition Time for the run")
+    functional_file = File(exists=True, mandatory=True, desc="BOLD file the model is fit to")
+    oversampling = traits.Int(
+        20, usedefault=True, desc="Number of time points the model is built at per volume"
+    )
+
+
+class _GenerateRunDesignOutputSpec(TraitedSpec):
+    design_file = File(exists=True, desc="Design matrix in FSL format")
+    con_file = File(exists=True, desc="T contrast matrix in FSL format")
+
+
+class GenerateRunDesign(IOBase):
+    """
+    Build run level design and contrast matrices without FEAT.
+
+    Replaces SpecifyModel, Level1Design, FEATModel and correct_matrix. Events
+    are modelled at ``oversampling`` time points per volume, convolved with
+    FSL's double-gamma HRF and sampled at the middle of each volume. As in FEAT
+    every column is demeaned, ``legendre00`` is kept as an intercept like
+    correct_matrix does. Other constant columns, like a condition without
+    events in the run, are left at zero with a warning.
+    """
+
+    input_spec = _GenerateRunDesignInputSpec
+    output_spec = _GenerateRunDesignOutputSpec
+
+    def _list_outputs(self):
+        from ..utils import write_vest
+
+        run_info = self.inputs.run_info
+        n_volumes = image_shape(self.inputs.functional_file)[3]
+        conditions = _convolve_conditions(
+            onsets=run_info.onsets,
+            durations=run_info.durations,
+            amplitudes=run_info.amplitudes,
+            n_volumes=n_volumes,
+            repetition_time=self.inputs.repetition_time,
+            oversampling=self.inputs.oversampling,
+        )
+        columns = list(conditions) + [np.asarray(reg, dtype=float) for reg in run_info.regressors]
+        names = list(run_info.conditions) + list(run_info.regressor_names)
+        design = np.column_stack(columns)
+        constant = np.ptp(design, axis=0) == 0
+        intercept = np.array([name == "legendre00" for name in names])
+        design = design - design.mean(axis=0)
+        design[:, intercept] = 1
+        for name in np.asarray(names)[constant & ~intercept]:
+            iflogger.warning(
+                f"Regressor {name} is constant in {self.inputs.functional_file}, "
+                "its estimates will be zero"
+            )
+
+        contrast_names = []
+        contrast_matrix = []
+        for name, contrast_type, contrast_conditions, weights in self.inputs.contrasts:
+            if contrast_type != "T":
+                continue
+            contrast_vector = np.zeros(len(names))
+            for condition, weight in zip(contrast_conditions, weights):
+                if condition not in names:
+                    raise ValueError(f"Contrast {name} references unknown regressor {condition}")
+                contrast_vector[names.index(condition)] = weight
+            contrast_names.append(name)
+            contrast_matrix.append(contrast_vector)
+
+        design_file = write_vest(
+            design,
+            Path.cwd() / "run0.mat",
+            header={"PPheights": [f"{height:e}" for height in np.ptp(design, axis=0)]},
+        )
+        contrast_header = {
+            f"ContrastName{idx}": name for idx, name in enumerate(contrast_names, start=1)
+        }
+        contrast_header["NumContrasts"] = len(contrast_names)
+        con_file = write_vest(
+            np.reshape(contrast_matrix, (-1, len(names))),
+            Path.cwd() / "run0.con",
+            header=contrast_header,
+        )
+        return {"design_file": design_file, "con_file": con_file}
+
+
+def _double_gamma_hrf(time_step, length=32.0):
+    """Sample FSL's double-gamma HRF, normalized to unit sum."""
+    from scipy import stats
+
+    times = np.arange(0, length, time_step)
+    hrf = stats.gamma.pdf(times, 6) - stats.gamma.pdf(times, 16) / 6
+    return hrf / hrf.sum()
+
+
+def _convolve_conditions(onsets, durations, amplitudes, n_volumes, repetition_time, oversampling):
+    """Convolve boxcars of every condition with the HRF, sampled once per volume."""
+    from scipy import signal
+
+    n_conditions = len(onsets)
+    if not n_conditions:
+        return np.zeros((0, n_volumes))
+    n_samples = n_volumes * oversampling
+    time_step = repetition_time / oversampling
+    if amplitudes is None:
+        amplitudes = [np.ones(len(cond_onsets)) for cond_onsets in onsets]
+    rows = np.concatenate(
+        [np.full(len(cond_onsets), idx, dtype=int) for idx, cond_onsets in enumerate(onsets)]
+    )
+    onsets = np.concatenate([np.ravel(cond_onsets) for cond_onsets in onsets])
+    durations = np.concatenate([np.ravel(cond_durations) for cond_durations in durations])
+    amplitudes = np.concatenate([np.ravel(cond_amplitudes) for cond_amplitudes in amplitudes])
+
+    # Events are added as steps and integrated, zero durations last one sample
+    starts = np.clip(np.round(onsets / time_step).astype(int), 0, n_samples)
+    stops = np.round((onsets + durations) / time_step).astype(int)
+    stops = np.clip(np.maximum(stops, starts + 1), 0, n_samples)
+    boxcars = np.zeros((n_conditions, n_samples + 1))
+    np.add.at(boxcars, (rows, starts), amplitudes)
+    np.add.at(boxcars, (rows, stops), -amplitudes)
+    boxcars = np.cumsum(boxcars[:, :-1], axis=1)
+
+    hrf = _double_gamma_hrf(time_step)
+    convolved = signal.fftconvolve(boxcars, hrf[np.newaxis], axes=1)[:, :n_samples]
+    return convolved[:, np.arange(n_volumes) * oversampling + oversampling // 2]
+
+
+class _GenerateHigherInfoInputSpec(OutputTypeInputSpec):
     contrast_maps = InputMultiPath(File(exists=True), desc="List of statmaps from previous level")
     contrast_metadata = traits.List(desc="Contrast entities inherited from previous levels")
     model = traits.Dict(desc="Step level information from the model file")
@@ -205,6 +499,12 @@ class _GenerateHigherInfoInputSpec(BaseInterfaceInputSpec):
             "if not value is specified, will not functional file",
         ),
     )
+    merge_maps = traits.Bool(
+        True,
+        usedefault=True,
+        desc="Write merged 4D maps and design matrices for FLAMEO, "
+        "otherwise only group the input maps by contrast",
+    )
 
 
 class _GenerateHigherInfoOutputSpec(TraitedSpec):
@@ -216,6 +516,9 @@ class _GenerateHigherInfoOutputSpec(TraitedSpec):
     covariance_matrices = traits.List()
     contrast_metadata = traits.List()
     brain_mask = traits.List()
+    grouped_effect_maps = traits.List(desc="Input effect maps grouped by contrast")
+    grouped_variance_maps = traits.List(desc="Input variance maps grouped by contrast")
+    grouped_dofs = traits.List(desc="Degrees of freedom of each grouped input map")
 
 
 class GenerateHigherInfo(IOBase):
@@ -227,15 +530,16 @@ class GenerateHigherInfo(IOBase):
     _always_run = True
 
     def _list_outputs(self):
-        from bids import BIDSLayout
-
-        layout = BIDSLayout.load(self.inputs.database_path)
+        layout = load_layout(self.inputs.database_path)
         organization = self._get_organization()
+        if not self.inputs.merge_maps:
+            return self._group_maps(organization=organization, layout=layout)
+
         (contrast_entities, effect_maps, variance_maps, dof_maps, brain_masks,) = self._merge_maps(
             organization=organization, layout=layout
         )
         (design_matrices, contrast_matrices, covariance_matrices,) = self._produce_matrices(
-            contrast_entities=contrast_entities, layout=layout
+            contrast_entities=contrast_entities
         )
         return {
             "effect_maps": effect_maps,
@@ -264,16 +568,23 @@ class GenerateHigherInfo(IOBase):
             if "space" not in contrast_ents or contrast_ents["space"] is None:
                 contrast_ents["space"] = "bold"
             org_key = ".".join(fields).format(**contrast_ents)
+            # Effect and variance maps of a contrast share this key, and the entities of each map
+            pair_key = tuple(contrast_ents[field] for field in split_fields if field != "stat")
             if contrast_ents["space"] == "bold":
                 contrast_ents.pop("space")
 
             degrees_of_freedom = contrast_ents.pop("DegreesOfFreedom", None)
+            map_key = tuple(
+                sorted((key, str(value)) for key, value in contrast_ents.items() if key != "stat")
+            )
             if org_key not in organization.keys():
-                organization[org_key] = {"Files": [contrast_file]}
+                organization[org_key] = {"Files": [contrast_file], "Pair": pair_key}
+                organization[org_key]["Maps"] = [map_key]
                 organization[org_key]["Metadata"] = contrast_ents.copy()
                 organization[org_key]["Metadata"]["DegreesOfFreedom"] = [degrees_of_freedom]
             else:
                 organization[org_key]["Files"].append(contrast_file)
+                organization[org_key]["Maps"].append(map_key)
                 organization[org_key]["Metadata"]["DegreesOfFreedom"].append(degrees_of_freedom)
         for org_key in organization:
             organization[org_key]["Metadata"]["NumLevelTimepoints"] = len(
@@ -287,7 +598,11 @@ class GenerateHigherInfo(IOBase):
         merged_patt = (
             "sub-{subject}_[ses-{session}_][space-{space}_]"
             "contrast-{contrast}_stat-{stat}_"
-            "desc-merged_statmap.nii.gz"
+            f"desc-merged_statmap{OUTPUT_EXTENSIONS[self.inputs.output_type]}"
+        )
+        dof_patt = (
+            "sub-{subject}_[ses-{session}_][space-{space}_]stat-dof_"
+            f"desc-{{desc}}_statmap{OUTPUT_EXTENSIONS[self.inputs.output_type]}"
         )
         maps_info = {
             "effect_maps": [],
@@ -296,63 +611,37 @@ class GenerateHigherInfo(IOBase):
             "map_entities": [],
             "mask_files": [],
         }
+        # Contrasts estimated from the same runs share one DOF map
+        dof_maps = {}
         for org in organization:
             metadata = organization[org]["Metadata"]
             org_files = organization[org]["Files"]
-            merged_image = nb.concat_images([nb.load(file) for file in sorted(org_files)])
+            reference = nb.load(org_files[0])
 
             if "effect" in org:
-                dof_data = np.ones_like(merged_image.get_fdata())
-                dofs = metadata.pop("DegreesOfFreedom")
-
-                if self.inputs.align_volumes and "run" not in metadata:
-                    raise ValueError(
-                        "align_volumes is specified, but dataset "
-                        "does not appear to contain multiple runs"
-                    )
-                elif self.inputs.align_volumes:
-                    align_volume = self.inputs.align_volumes
-                    mask_entities = {
-                        **metadata,
-                        "desc": "brain",
-                        "suffix": "mask",
-                        "run": align_volume,
-                    }
-                else:
-                    mask_entities = {
-                        **metadata,
-                        "desc": "brain",
-                        "suffix": "mask",
-                    }
-                mask_path = layout.get(**mask_entities)
-                if len(mask_path) > 1:
-                    raise ValueError("Entities given produced " "more than one mask file")
-                if isinstance(mask_path, list):
-                    mask_path = str(Path(mask_path[0].path).as_posix())
-                maps_info["mask_files"].append(mask_path)
-
-                if metadata["space"] is None:
-                    metadata.pop("space", None)
-                    metadata.pop("run", None)
-                metadata.pop("stat", None)
-                maps_info["map_entities"].append(metadata.copy())
+                org_files, dofs = zip(*sorted(zip(org_files, metadata.pop("DegreesOfFreedom"))))
+                maps_info["mask_files"].append(self._get_mask(metadata, layout))
+                maps_info["map_entities"].append(self._get_map_entities(metadata, dofs))
                 metadata["contrast"] = snake_to_camel(metadata["contrast"])
 
-                stat_name = "dof"
-                for i, dof in enumerate(dofs):
-                    dof_data[:, :, :, i] *= float(dof)
-                dof_path = layout.build_path(
-                    {**metadata, "stat": stat_name}, path_patterns=merged_patt, validate=False,
-                )
-                dof_path = str((Path.cwd() / dof_path).as_posix())
-                dof_image = nb.nifti1.Nifti1Image(dof_data, merged_image.affine)
-                maps_info["dof_maps"].append(dof_path)
-                nb.nifti1.save(dof_image, dof_path)
+                dof_key = (dofs, reference.shape[:3], reference.affine.tobytes())
+                if dof_key not in dof_maps:
+                    # Named after the values and geometry it holds, not a contrast
+                    dof_hash = hashlib.sha1(repr(dof_key).encode()).hexdigest()[:8]
+                    dof_path = build_bids_path(
+                        {**metadata, "desc": dof_hash}, path_patterns=dof_patt
+                    )
+                    dof_maps[dof_key] = self._write_dof_map(
+                        dofs, reference, str((Path.cwd() / dof_path).as_posix())
+                    )
+                maps_info["dof_maps"].append(dof_maps[dof_key])
 
                 stat_name = "effect"
+            else:
+                org_files = sorted(org_files)
             if "variance" in org:
                 stat_name = "variance"
-            merged_path = layout.build_path(
+            merged_path = build_bids_path(
                 {
                     **metadata,
                     "stat": stat_name,
@@ -361,11 +650,15 @@ class GenerateHigherInfo(IOBase):
                     "contrast": snake_to_camel(metadata["contrast"]),
                 },
                 path_patterns=merged_patt,
-                validate=False,
             )
             merged_path = str((Path.cwd() / merged_path).as_posix())
             maps_info[f"{stat_name}_maps"].append(merged_path)
-            nb.nifti1.save(merged_image, merged_path)
+            write_volumes(
+                (nb.load(file).get_fdata(dtype=np.float32) for file in org_files),
+                len(org_files),
+                reference,
+                merged_path,
+            )
 
         return (
             maps_info["map_entities"],
@@ -375,7 +668,102 @@ class GenerateHigherInfo(IOBase):
             maps_info["mask_files"],
         )
 
-    def _produce_matrices(self, contrast_entities, layout):
+    @staticmethod
+    def _write_dof_map(dofs, reference, dof_path):
+        """Write constant DOF volumes, as int16 when every value is a small integer."""
+        dtype = np.float32
+        if all(float(dof).is_integer() and 0 <= dof <= np.iinfo(np.int16).max for dof in dofs):
+            dtype = np.int16
+        return write_volumes(
+            (np.full(reference.shape[:3], dof, dtype=dtype) for dof in dofs),
+            len(dofs),
+            reference,
+            dof_path,
+            dtype=dtype,
+        )
+
+    def _group_maps(self, organization, layout):
+        maps_info = {
+            "contrast_metadata": [],
+            "grouped_effect_maps": [],
+            "grouped_variance_maps": [],
+            "grouped_dofs": [],
+            "brain_mask": [],
+        }
+        effect_orgs = [org for org in organization if "effect" in org]
+        variance_orgs = {
+            organization[org]["Pair"]: organization[org]
+            for org in organization
+            if "variance" in org
+        }
+        for effect_org in effect_orgs:
+            metadata = organization[effect_org]["Metadata"]
+            variance_org = variance_orgs.get(organization[effect_org]["Pair"])
+            if variance_org is None:
+                raise ValueError(f"No variance maps found for the effect maps of {effect_org}")
+            variance_files = dict(zip(variance_org["Maps"], variance_org["Files"]))
+            effect_files, dofs, map_keys = zip(
+                *sorted(
+                    zip(
+                        organization[effect_org]["Files"],
+                        metadata.pop("DegreesOfFreedom"),
+                        organization[effect_org]["Maps"],
+                    )
+                )
+            )
+            missing = [
+                effect_file
+                for effect_file, map_key in zip(effect_files, map_keys)
+                if map_key not in variance_files
+            ]
+            if missing:
+                raise ValueError(f"No variance map found for effect maps {missing}")
+            maps_info["brain_mask"].append(self._get_mask(metadata, layout))
+            maps_info["contrast_metadata"].append(self._get_map_entities(metadata, dofs))
+            maps_info["grouped_effect_maps"].append(list(effect_files))
+            maps_info["grouped_variance_maps"].append(
+                [variance_files[map_key] for map_key in map_keys]
+            )
+            maps_info["grouped_dofs"].append(list(dofs))
+        return maps_info
+
+    def _get_mask(self, metadata, layout):
+        if self.inputs.align_volumes and "run" not in metadata:
+            raise ValueError(
+                "align_volumes is specified, but dataset "
+                "does not appear to contain multiple runs"
+            )
+        elif self.inputs.align_volumes:
+            align_volume = self.inputs.align_volumes
+            mask_entities = {
+                **metadata,
+                "desc": "brain",
+                "suffix": "mask",
+                "run": align_volume,
+            }
+        else:
+            mask_entities = {
+                **metadata,
+                "desc": "brain",
+                "suffix": "mask",
+            }
+        mask_path = layout.get(**mask_entities)
+        if len(mask_path) > 1:
+            raise ValueError("Entities given produced " "more than one mask file")
+        if isinstance(mask_path, list):
+            mask_path = str(Path(mask_path[0].path).as_posix())
+        return mask_path
+
+    @staticmethod
+    def _get_map_entities(metadata, dofs):
+        if metadata["space"] is None:
+            metadata.pop("space", None)
+            metadata.pop("run", None)
+        metadata.pop("stat", None)
+        # Fixed effects pass the summed degrees of freedom on to the next level
+        return {**metadata, "DegreesOfFreedom": sum(dofs)}
+
+    def _produce_matrices(self, contrast_entities):
 
         matrix_paths = {
             "design_matrices": [],
@@ -404,8 +792,8 @@ class GenerateHigherInfo(IOBase):
             ents = entity.copy()
             ents["contrast"] = snake_to_camel(ents["contrast"])
             for matrix_type in ["design", "contrast", "covariance"]:
-                matrix_path = layout.build_path(
-                    {**ents, "desc": matrix_type}, path_patterns=matrix_patt, validate=False,
+                matrix_path = build_bids_path(
+                    {**ents, "desc": matrix_type}, path_patterns=matrix_patt
                 )
                 matrix_path = Path.cwd() / matrix_path
                 if matrix_path.is_file():  # Remove file if it exists
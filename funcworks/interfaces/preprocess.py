@@ -0,0 +1,304 @@
+"""Native interfaces for preparing functional images without calling FSL binaries."""
+from itertools import product
+from pathlib import Path
+from nipype.interfaces.base import (
+    BaseInterfaceInputSpec,
+    TraitedSpec,
+    File,
+    traits,
+    SimpleInterface,
+)
+import nibabel as nb
+import numpy as np
+from .base import OutputTypeInputSpec
+from ..utils import OUTPUT_EXTENSIONS, load_timeseries, smooth_in_mask, save_image
+
+# Largest size of the usan weights SusanSmooth keeps for every chunk of volumes
+_USAN_WEIGHTS_BYTES = 256 << 20
+
+
+class _MaskTimeseriesInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="4D BOLD series to mask")
+    mask_file = File(exists=True, mandatory=True, desc="Brain mask, nonzero voxels are kept")
+
+
+class _MaskTimeseriesOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="Uncompressed (timepoints x voxels) float32 .npy matrix")
+    index_file = File(exists=True, desc="Flat (C order) indices of the in-mask voxels")
+
+
+class MaskTimeseries(SimpleInterface):
+    """
+    Apply a brain mask in process and keep only the in-mask voxels.
+
+    Replaces ``fslmaths -mas``, instead of a full size gzipped 4D copy of the
+    series a (timepoints x voxels) matrix is written as an uncompressed ``.npy``
+    file that downstream nodes can memory map. Columns are ordered like
+    ``data[mask]``, the flat voxel index of every column is saved alongside.
+    """
+
+    input_spec = _MaskTimeseriesInputSpec
+    output_spec = _MaskTimeseriesOutputSpec
+
+    def _run_interface(self, runtime):
+        image = nb.load(self.inputs.in_file)
+        mask = np.asanyarray(nb.load(self.inputs.mask_file).dataobj) > 0
+        if image.ndim != 4 or image.shape[:3] != mask.shape:
+            raise ValueError(
+                f"{self.inputs.in_file} with shape {image.shape} does not match "
+                f"mask {self.inputs.mask_file} with shape {mask.shape}"
+            )
+
+        base = Path(self.inputs.in_file).name.split(".")[0]
+        out_file = str(Path(runtime.cwd) / f"{base}_masked.npy")
+        index_file = str(Path(runtime.cwd) / f"{base}_maskidx.npy")
+
+        data = image.get_fdata(dtype=np.float32)
+        timeseries = np.lib.format.open_memmap(
+            out_file, mode="w+", dtype=np.float32, shape=(image.shape[3], int(mask.sum()))
+        )
+        for idx in range(image.shape[3]):
+            timeseries[idx] = data[..., idx][mask]
+        timeseries.flush()
+        del timeseries, data
+        np.save(index_file, np.flatnonzero(mask))
+
+        self._results["out_file"] = out_file
+        self._results["index_file"] = index_file
+
+        return runtime
+
+
+class _SusanStatisticsInputSpec(OutputTypeInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="4D BOLD series to be smoothed")
+    mask_file = File(exists=True, mandatory=True, desc="Brain mask of the series")
+
+
+class _SusanStatisticsOutputSpec(TraitedSpec):
+    mean_file = File(exists=True, desc="Temporal mean image restricted to the mask")
+    median_value = traits.Float(desc="Median intensity of all in-mask samples")
+
+
+class SusanStatistics(SimpleInterface):
+    """
+    Compute the temporal mean image and the masked median used to configure SUSAN.
+
+    Matches ``fslmaths -Tmean -mas`` and ``fslstats -k -p 50`` while reading
+    the series only once.
+    """
+
+    input_spec = _SusanStatisticsInputSpec
+    output_spec = _SusanStatisticsOutputSpec
+
+    def _run_interface(self, runtime):
+        image = nb.load(self.inputs.in_file)
+        mask = np.asanyarray(nb.load(self.inputs.mask_file).dataobj) > 0
+        data = image.get_fdata(dtype=np.float32)
+        if data.shape[:3] != mask.shape:
+            raise ValueError(
+                f"{self.inputs.in_file} with shape {data.shape} does not match "
+                f"mask {self.inputs.mask_file} with shape {mask.shape}"
+            )
+
+        mean_data = np.zeros(mask.shape, dtype=np.float32)
+        in_mask = data[mask]
+        mean_data[mask] = in_mask.mean(axis=-1, dtype=np.float64)
+        median_value = float(np.median(in_mask, overwrite_input=True)) if mask.any() else 0.0
+
+        base = Path(self.inputs.in_file).name.split(".")[0]
+        extension = OUTPUT_EXTENSIONS[self.inputs.output_type]
+        mean_file = str(Path(runtime.cwd) / f"{base}_mean{extension}")
+        header = image.header.copy()
+        header.set_data_dtype(np.float32)
+        save_image(nb.Nifti1Image(mean_data, image.affine, header), mean_file)
+
+        self._results["mean_file"] = mean_file
+        self._results["median_value"] = median_value
+
+        return runtime
+
+
+class _IsotropicSmoothInputSpec(OutputTypeInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="4D BOLD series to smooth")
+    mask_file = File(exists=True, mandatory=True, desc="Brain mask restricting the kernel")
+    fwhm = traits.Float(mandatory=True, desc="Full width at half maximum of the kernel in mm")
+    batch_size = traits.Int(16, usedefault=True, desc="Number of volumes filtered together")
+    num_threads = traits.Int(1, usedefault=True, nohash=True, desc="Number of threads to use")
+
+
+class _IsotropicSmoothOutputSpec(TraitedSpec):
+    smoothed_file = File(exists=True, desc="Smoothed series, zero outside of the mask")
+
+
+class IsotropicSmooth(SimpleInterface):
+    """
+    Smooth a 4D series with an isotropic Gaussian kernel restricted to the brain mask.
+
+    Separable 1D convolutions are applied to batches of volumes, batches are
+    spread over a thread pool. Kernel weights are renormalized within the mask
+    so signal from outside of the brain does not bleed into edge voxels.
+    """
+
+    input_spec = _IsotropicSmoothInputSpec
+    output_spec = _IsotropicSmoothOutputSpec
+
+    def _run_interface(self, runtime):
+        timeseries, mask, reference = load_timeseries(self.inputs.in_file, self.inputs.mask_file)
+        smoothed = smooth_in_mask(
+            timeseries,
+            mask,
+            reference.header.get_zooms()[:3],
+            self.inputs.fwhm,
+            batch_size=self.inputs.batch_size,
+            num_threads=self.inputs.num_threads,
+        )
+        del timeseries
+
+        data = np.zeros(reference.shape, dtype=np.float32)
+        data[mask] = smoothed.T
+        header = reference.header.copy()
+        header.set_data_dtype(np.float32)
+
+        base = Path(self.inputs.in_file).name.split(".")[0]
+        extension = OUTPUT_EXTENSIONS[self.inputs.output_type]
+        smoothed_file = str(Path(runtime.cwd) / f"{base}_smooth{extension}")
+        save_image(nb.Nifti1Image(data, reference.affine, header), smoothed_file)
+        self._results["smoothed_file"] = smoothed_file
+
+        return runtime
+
+
+class _SusanSmoothInputSpec(OutputTypeInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="4D BOLD series to smooth")
+    fwhm = traits.Float(mandatory=True, desc="Full width at half maximum of the kernel in mm")
+    brightness_threshold = traits.Float(
+        mandatory=True, desc="Intensity difference treated as an edge, used without usans"
+    )
+    dimension = traits.Enum(3, 2, usedefault=True, desc="Smooth within 3D volumes or 2D slices")
+    usans = traits.List(
+        traits.Tuple(File(exists=True), traits.Float),
+        maxlen=1,
+        usedefault=True,
+        desc="Image and brightness threshold used to find edges instead of each volume",
+    )
+    use_median = traits.Bool(
+        True, usedefault=True, desc="Use the local median where no neighbour is similar enough"
+    )
+    chunk_size = traits.Int(32, usedefault=True, desc="Number of volumes smoothed together")
+
+
+class _SusanSmoothOutputSpec(TraitedSpec):
+    smoothed_file = File(exists=True, desc="Smoothed series")
+
+
+class SusanSmooth(SimpleInterface):
+    """
+    Edge preserving SUSAN smoothing computed in process.
+
+    Follows FSL's ``susan``: every voxel becomes the average of its neighbours
+    within a box of ``1.5 * sigma`` (plus one voxel), weighted by a Gaussian of
+    their distance and by ``exp(-(dI / bt) ** 2)`` for their intensity
+    difference in the usan image. The central voxel is left out and the median
+    of the direct neighbours is used where no neighbour contributes. With a
+    usan the weights are shared by every volume, and kept across chunks of
+    ``chunk_size`` volumes while they fit in a fixed memory budget. Larger
+    kernels recompute them from the 3D usan for every chunk to bound memory.
+    """
+
+    input_spec = _SusanSmoothInputSpec
+    output_spec = _SusanSmoothOutputSpec
+
+    def _run_interface(self, runtime):
+        image = nb.load(self.inputs.in_file)
+        data = image.get_fdata(dtype=np.float32)
+        zooms = np.asarray(image.header.get_zooms()[:3])
+        sigmas = self.inputs.fwhm / np.sqrt(8 * np.log(2)) / zooms
+        radii = [int(1.5 * sigma) + 1 for sigma in sigmas]
+        if self.inputs.dimension == 2:
+            radii[2] = 0
+        usan, usan_weights = None, None
+        if self.inputs.usans:
+            usan_file, brightness_threshold = self.inputs.usans[0]
+            usan = nb.load(usan_file).get_fdata(dtype=np.float32)[..., np.newaxis]
+            # The usan does not change between volumes, its weights are kept
+            # for every chunk when they fit in the budget
+            n_offsets = np.prod([2 * radius + 1 for radius in radii]) - 1
+            if n_offsets * usan.size * 4 <= _USAN_WEIGHTS_BYTES:
+                usan_weights = list(_susan_weights(usan, brightness_threshold, sigmas, radii))
+
+        smoothed = np.empty_like(data)
+        for start in range(0, data.shape[3], self.inputs.chunk_size):
+            chunk = data[..., start : start + self.inputs.chunk_size]
+            if usan_weights is not None:
+                weights = usan_weights
+            elif usan is not None:
+                weights = _susan_weights(usan, brightness_threshold, sigmas, radii)
+            else:
+                weights = _susan_weights(chunk, self.inputs.brightness_threshold, sigmas, radii)
+            smoothed[..., start : start + self.inputs.chunk_size] = _susan_smooth(
+                chunk, weights, radii, use_median=self.inputs.use_median
+            )
+        del data
+
+        header = image.header.copy()
+        header.set_data_dtype(np.float32)
+        base = Path(self.inputs.in_file).name.split(".")[0]
+        extension = OUTPUT_EXTENSIONS[self.inputs.output_type]
+        smoothed_file = str(Path(runtime.cwd) / f"{base}_smooth{extension}")
+        save_image(nb.Nifti1Image(smoothed, image.affine, header), smoothed_file)
+        self._results["smoothed_file"] = smoothed_file
+
+        return runtime
+
+
+def _shifted(array, offset, radii, shape):
+    """Return the view of a padded ``array`` shifted by ``offset`` voxels."""
+    return array[
+        tuple(
+            slice(radius + shift, radius + shift + size)
+            for radius, shift, size in zip(radii, offset, shape)
+        )
+    ]
+
+
+def _susan_weights(usan, brightness_threshold, sigmas, radii):
+    """Yield every neighbour offset with its distance and brightness weights."""
+    padding = [(radius, radius) for radius in radii] + [(0, 0)]
+    padded_usan = np.pad(usan, padding)
+    inside = np.pad(np.ones(usan.shape[:3], dtype=bool), padding[:3])[..., np.newaxis]
+    for offset in product(*[range(-radius, radius + 1) for radius in radii]):
+        if not any(offset):
+            continue
+        distance = np.exp(-0.5 * np.sum((np.asarray(offset) / sigmas) ** 2))
+        neighbour = _shifted(padded_usan, offset, radii, usan.shape)
+        difference = (neighbour - usan) / brightness_threshold
+        yield offset, (
+            distance
+            * np.exp(-difference * difference)
+            * _shifted(inside, offset, radii, usan.shape)
+        ).astype(np.float32)
+
+
+def _susan_smooth(data, weights, radii, use_median=True):
+    """SUSAN smooth a chunk of volumes, ``weights`` broadcast against ``data``."""
+    padding = [(radius, radius) for radius in radii] + [(0, 0)]
+    padded = np.pad(data, padding)
+    total = np.zeros(data.shape, dtype=np.float32)
+    weight_sum = 0
+    for offset, offset_weights in weights:
+        total += offset_weights * _shifted(padded, offset, radii, data.shape)
+        weight_sum = weight_sum + offset_weights
+
+    smoothed = np.zeros_like(total)
+    np.divide(total, weight_sum, out=smoothed, where=weight_sum > 0)
+    isolated = np.broadcast_to(weight_sum == 0, data.shape)
+    if use_median and isolated.any():
+        padded_nan = np.pad(data, padding, constant_values=np.nan)
+        adjacent = [range(-min(radius, 1), min(radius, 1) + 1) for radius in radii]
+        neighbours = [
+            _shifted(padded_nan, offset, radii, data.shape)[isolated]
+            for offset in product(*adjacent)
+            if any(offset)
+        ]
+        smoothed[isolated] = np.nanmedian(np.stack(neighbours), axis=0)
+    return smoothed
@@ -12,7 +12,7 @@ import pandas as pd
 import numpy as np
 import seaborn as sns
 from matplotlib import pyplot as plt
-from bids import BIDSLayout
+from ..utils import build_bids_path
 
 sns.set_style("white")
 
@@ -21,7 +21,6 @@ class _PlotMatricesInputSpec(BaseInterfaceInputSpec):
     run_info = traits.Any(desc="List of regressors of no interest")
     mat_file = File(exists=True, desc="Matrix File produced by Generate Model")
     con_file = File(exists=True, desc="Contrast File Produces by Generate Model")
-    database_path = Directory(exists=True, desc="Database path for current model")
     entities = traits.Dict(desc="Dictionary containing BIDS file entities")
     output_dir = Directory(desc="Directory for Output")
 
@@ -46,7 +45,6 @@ class PlotMatrices(IOBase):
         regressor_names = run_info.conditions
         confound_names = run_info.regressor_names
         output_dir = Path(self.inputs.output_dir)
-        layout = BIDSLayout.load(self.inputs.database_path)
         image_pattern = (
             "reports/[sub-{subject}/][ses-{session}/]"
             "figures/[run-{run}/]"
@@ -75,24 +73,21 @@ class PlotMatrices(IOBase):
             path_pattern=image_pattern,
             suffix="design",
             cmap="viridis",
-            layout=layout,
         )
         con_plot = self._plot_matrix(
             matrix=contrast_matrix,
             path_pattern=image_pattern,
             suffix="contrasts",
             cmap="RdBu_r",
-            layout=layout,
         )
         corr_plot = self._plot_corr_matrix(
             corr_matrix=corr_matrix,
             path_pattern=image_pattern,
             regressor_names=regressor_names,
             cmap="RdBu_r",
-            layout=layout,
         )
         ents.update({"suffix": "design"})
-        design_path = layout.build_path(ents, path_patterns=design_matrix_patt, validate=False)
+        design_path = build_bids_path(ents, path_patterns=design_matrix_patt)
         design_path = output_dir / design_path
         design_path.parent.mkdir(exist_ok=True, parents=True)
         design_matrix.to_csv(design_path, sep="\t", index=None)
@@ -126,7 +121,7 @@ class PlotMatrices(IOBase):
 
         return design_matrix, corr_matrix, contrast_matrix
 
-    def _plot_matrix(self, matrix, path_pattern, suffix=None, cmap="viridis", layout=None):
+    def _plot_matrix(self, matrix, path_pattern, suffix=None, cmap="viridis"):
         fig = plt.figure(figsize=(14, 10))
         vmax = np.abs(matrix.values).max()
         sns.heatmap(
@@ -139,7 +134,7 @@ class PlotMatrices(IOBase):
         )
         entities = self.inputs.entities
         entities.update({"suffix": suffix})
-        fig_path = layout.build_path(entities, path_patterns=path_pattern, validate=False)
+        fig_path = build_bids_path(entities, path_patterns=path_pattern)
         fig_path = Path(self.inputs.output_dir) / fig_path
         fig_path.parent.mkdir(exist_ok=True, parents=True)
         plt.savefig(fig_path, bbox_inches="tight")
@@ -148,7 +143,7 @@ class PlotMatrices(IOBase):
         return fig_path
 
     def _plot_corr_matrix(
-        self, corr_matrix, path_pattern, regressor_names, cmap=None, layout=None,
+        self, corr_matrix, path_pattern, regressor_names, cmap=None,
     ):
         fig = plt.figure(figsize=(10, 10))
         plot = sns.heatmap(
@@ -170,7 +165,7 @@ class PlotMatrices(IOBase):
         plot.vlines([len(regressor_names)], 0, len(regressor_names))
         entities = self.inputs.entities
         entities.update({"suffix": "corr"})
-        fig_path = layout.build_path(entities, path_patterns=path_pattern, validate=False)
+        fig_path = build_bids_path(entities, path_patterns=path_pattern)
         fig_path = Path(self.inputs.output_dir) / fig_path
         fig_path.parent.mkdir(exist_ok=True, parents=True)
         plt.savefig(fig_path, bbox_inches="tight")
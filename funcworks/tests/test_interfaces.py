@@ -0,0 +1,597 @@
+"""Tests for interfaces."""
+import numpy as np
+import nibabel as nb
+from pathlib import Path
+from nipype.utils.filemanip import ensure_list
+from funcworks import utils
+
+
+def test__estimate_run_model_pvals(tmp_path, monkeypatch):
+    """Test EstimateRunModel p-values outside the mask."""
+    from funcworks.interfaces.glm import EstimateRunModel
+
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.RandomState(0)
+    design = np.column_stack([np.tile([1.0, 0.0], 20), np.ones(40)])
+    data = rng.randn(4, 4, 3, 40) + 10 * design[:, 0]
+    mask = np.zeros(data.shape[:3], dtype=np.uint8)
+    mask[1:3, 1:3, :] = 1
+    nb.save(nb.Nifti1Image(data.astype(np.float32), np.eye(4)), "bold.nii.gz")
+    nb.save(nb.Nifti1Image(mask, np.eye(4)), "mask.nii.gz")
+    utils.write_vest(design, "design.mat")
+    utils.write_vest(np.array([[1.0, 0.0]]), "design.con")
+
+    result = EstimateRunModel(
+        in_file="bold.nii.gz",
+        mask_file="mask.nii.gz",
+        design_file="design.mat",
+        tcon_file="design.con",
+    ).run()
+    pvals = nb.load(ensure_list(result.outputs.pvals)[0]).get_fdata()
+    assert np.all(pvals[mask == 0] == 0.5)
+    assert np.all(pvals[mask > 0] < 0.05)
+
+
+def test__estimate_run_model_ols(tmp_path, monkeypatch):
+    """Test EstimateRunModel against a closed form least squares fit."""
+    from funcworks.interfaces.glm import EstimateRunModel
+    from funcworks.interfaces.preprocess import MaskTimeseries
+
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.RandomState(0)
+    n_timepoints = 60
+    design = np.column_stack(
+        [np.tile([1.0] * 5 + [0.0] * 5, 6), np.linspace(-1, 1, n_timepoints)]
+    )
+    design -= design.mean(axis=0)
+    contrasts = np.array([[1.0, 0.0], [1.0, -1.0]])
+    data = (
+        100
+        + 3 * design[:, 0]
+        - 2 * design[:, 1]
+        + rng.randn(4, 5, 3, n_timepoints)
+        * rng.uniform(0.5, 2.0, (4, 5, 3))[..., np.newaxis]
+    )
+    mask = np.zeros(data.shape[:3], dtype=np.uint8)
+    mask[1:3, 1:4, 1:] = 1
+    nb.save(nb.Nifti1Image(data.astype(np.float32), np.eye(4)), "bold.nii.gz")
+    nb.save(nb.Nifti1Image(mask, np.eye(4)), "mask.nii.gz")
+    utils.write_vest(design, "design.mat")
+    utils.write_vest(contrasts, "design.con")
+
+    timeseries = data.astype(np.float32)[mask > 0].T.astype(np.float64)
+    timeseries -= timeseries.mean(axis=0)
+    betas, rss, rank, _ = np.linalg.lstsq(design, timeseries, rcond=None)
+    dof = n_timepoints - rank
+    expected_copes = contrasts @ betas
+    expected_varcopes = np.outer(
+        np.diag(contrasts @ np.linalg.inv(design.T @ design) @ contrasts.T), rss / dof
+    )
+    expected_tstats = expected_copes / np.sqrt(expected_varcopes)
+
+    masked = MaskTimeseries(in_file="bold.nii.gz", mask_file="mask.nii.gz").run().outputs
+    for in_file, results_dir in [("bold.nii.gz", "image"), (masked.out_file, "matrix")]:
+        outputs = (
+            EstimateRunModel(
+                in_file=in_file,
+                mask_file="mask.nii.gz",
+                design_file="design.mat",
+                tcon_file="design.con",
+                results_dir=results_dir,
+                block_size=7,
+            )
+            .run()
+            .outputs
+        )
+        assert int(Path(outputs.dof_file).read_text()) == dof
+        for name, expected in [
+            ("copes", expected_copes),
+            ("varcopes", expected_varcopes),
+            ("tstats", expected_tstats),
+        ]:
+            stat_files = ensure_list(getattr(outputs, name))
+            assert len(stat_files) == len(contrasts)
+            for stat_file, expected_map in zip(stat_files, expected):
+                stat_map = nb.load(stat_file).get_fdata()
+                assert np.all(stat_map[mask == 0] == 0)
+                assert np.allclose(stat_map[mask > 0], expected_map, rtol=1e-4, atol=1e-5)
+
+
+def test__susan_statistics(tmp_path, monkeypatch):
+    """Test SusanStatistics against the masked mean and median."""
+    import pytest
+    from funcworks.interfaces.preprocess import SusanStatistics
+
+    monkeypatch.chdir(tmp_path)
+    data = np.random.RandomState(0).rand(5, 6, 4, 7).astype(np.float32) * 100
+    mask = np.zeros(data.shape[:3], dtype=np.uint8)
+    mask[1:4, 2:5, 1:3] = 1
+    nb.save(nb.Nifti1Image(data, np.eye(4)), "bold.nii.gz")
+    nb.save(nb.Nifti1Image(mask, np.eye(4)), "mask.nii.gz")
+
+    result = SusanStatistics(in_file="bold.nii.gz", mask_file="mask.nii.gz").run()
+    mean_data = nb.load(result.outputs.mean_file).get_fdata()
+    assert np.all(mean_data[mask == 0] == 0)
+    assert np.allclose(mean_data[mask > 0], data[mask > 0].mean(axis=-1), atol=1e-4)
+    assert np.isclose(result.outputs.median_value, np.median(data[mask > 0]))
+
+    nb.save(nb.Nifti1Image(mask[:-1], np.eye(4)), "short_mask.nii.gz")
+    with pytest.raises(ValueError, match="does not match"):
+        SusanStatistics(in_file="bold.nii.gz", mask_file="short_mask.nii.gz").run()
+
+
+def test__isotropic_smooth(tmp_path, monkeypatch):
+    """Test IsotropicSmooth keeps signal from outside of the mask out."""
+    from funcworks.interfaces.preprocess import IsotropicSmooth
+
+    monkeypatch.chdir(tmp_path)
+    mask = np.zeros((10, 10, 8), dtype=np.uint8)
+    mask[2:8, 2:8, 2:6] = 1
+    data = np.zeros(mask.shape + (3,), dtype=np.float32)
+    data[mask > 0] = 3.0
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    nb.save(nb.Nifti1Image(data, affine), "bold.nii.gz")
+    data[8, 4, 4] = 1000.0
+    nb.save(nb.Nifti1Image(data, affine), "bright.nii.gz")
+    nb.save(nb.Nifti1Image(mask, affine), "mask.nii.gz")
+
+    smoothed = []
+    for in_file in ["bold.nii.gz", "bright.nii.gz"]:
+        result = IsotropicSmooth(in_file=in_file, mask_file="mask.nii.gz", fwhm=6.0).run()
+        smoothed.append(nb.load(result.outputs.smoothed_file).get_fdata())
+    assert np.allclose(smoothed[1][mask > 0], 3.0)
+    assert np.array_equal(smoothed[0], smoothed[1])
+    assert np.all(smoothed[1][mask == 0] == 0)
+
+
+def test__susan_smooth(tmp_path, monkeypatch):
+    """Test SusanSmooth keeps a step edge while smoothing flat regions."""
+    from itertools import product
+    from funcworks.interfaces import preprocess
+    from funcworks.interfaces.preprocess import SusanSmooth
+
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.RandomState(0)
+    step = np.zeros((12, 8, 8), dtype=np.float32)
+    step[6:] = 100.0
+    data = step[..., np.newaxis] + 5 * rng.randn(12, 8, 8, 2).astype(np.float32)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    nb.save(nb.Nifti1Image(data, affine), "bold.nii.gz")
+    nb.save(nb.Nifti1Image(step, affine), "usan.nii.gz")
+
+    def _smooth(**kwargs):
+        result = SusanSmooth(in_file="bold.nii.gz", fwhm=5.0, **kwargs).run()
+        return nb.load(result.outputs.smoothed_file).get_fdata()
+
+    smoothed = _smooth(brightness_threshold=20.0)
+    flat = (slice(1, 4), slice(2, 6), slice(2, 6))
+    assert smoothed[flat].std() < 0.5 * data[flat].std()
+    assert np.allclose(
+        smoothed[6:8, 2:6, 2:6].mean() - smoothed[4:6, 2:6, 2:6].mean(), 100, atol=5
+    )
+
+    # A usan of the noise free step and its threshold replace the volumes when finding edges
+    with_usan = _smooth(brightness_threshold=20.0, usans=[(str(tmp_path / "usan.nii.gz"), 20.0)])
+    assert np.allclose(
+        with_usan[6:8, 2:6, 2:6].mean() - with_usan[4:6, 2:6, 2:6].mean(), 100, atol=5
+    )
+    # Weights of the usan are shared across chunks of volumes, or recomputed over budget
+    for budget in [preprocess._USAN_WEIGHTS_BYTES, 0]:
+        monkeypatch.setattr(preprocess, "_USAN_WEIGHTS_BYTES", budget)
+        assert np.allclose(
+            _smooth(
+                brightness_threshold=20.0,
+                usans=[(str(tmp_path / "usan.nii.gz"), 20.0)],
+                chunk_size=1,
+            ),
+            with_usan,
+        )
+
+    # Without brightness weighting the edge is blurred like a plain Gaussian
+    blurred = _smooth(brightness_threshold=1e6)
+    assert blurred[6, 2:6, 2:6].mean() - blurred[5, 2:6, 2:6].mean() < 60
+
+    # Reference value of one voxel, computed with susan's definition
+    sigma = 5.0 / np.sqrt(8 * np.log(2)) / 2.0
+    radius = int(1.5 * sigma) + 1
+    center = (5, 4, 4)
+    total = weight_sum = 0.0
+    for offset in product(range(-radius, radius + 1), repeat=3):
+        if not any(offset):
+            continue
+        voxel = tuple(c + o for c, o in zip(center, offset))
+        if not all(0 <= v < s for v, s in zip(voxel, step.shape)):
+            continue
+        weight = np.exp(-0.5 * np.sum((np.asarray(offset) / sigma) ** 2))
+        weight *= np.exp(-(((data[voxel + (0,)] - data[center + (0,)]) / 20.0) ** 2))
+        total += weight * data[voxel + (0,)]
+        weight_sum += weight
+    assert np.isclose(smoothed[center + (0,)], total / weight_sum, rtol=1e-4)
+
+
+def test__generate_run_design(tmp_path, monkeypatch):
+    """Test GenerateRunDesign against a design convolved by hand."""
+    from scipy import stats
+    from nipype.interfaces.base import Bunch
+    from funcworks.interfaces import modelgen
+    from funcworks.interfaces.modelgen import GenerateRunDesign
+
+    monkeypatch.chdir(tmp_path)
+    n_volumes, repetition_time, oversampling = 40, 2.0, 20
+    nb.save(
+        nb.Nifti1Image(np.zeros((2, 2, 2, n_volumes), dtype=np.float32), np.eye(4)), "bold.nii"
+    )
+    run_info = Bunch(
+        conditions=["task", "missing"],
+        onsets=[[10.0, 40.0], []],
+        durations=[[4.0, 4.0], []],
+        amplitudes=[[1.0, 2.0], []],
+        regressor_names=["legendre00", "legendre01", "zeros"],
+        regressors=[np.ones(n_volumes), np.linspace(-1, 1, n_volumes), np.zeros(n_volumes)],
+    )
+    result = GenerateRunDesign(
+        run_info=run_info,
+        contrasts=[("task", "T", ["task"], [1]), ("missing", "T", ["missing"], [1])],
+        repetition_time=repetition_time,
+        functional_file="bold.nii",
+        oversampling=oversampling,
+    ).run()
+    design, _ = utils.read_vest(result.outputs.design_file)
+    contrasts, _ = utils.read_vest(result.outputs.con_file)
+
+    time_step = repetition_time / oversampling
+    times = np.arange(n_volumes * oversampling) * time_step
+    boxcar = ((times >= 10) & (times < 14)) + 2.0 * ((times >= 40) & (times < 44))
+    hrf_times = np.arange(0, 32, time_step)
+    hrf = stats.gamma.pdf(hrf_times, 6) - stats.gamma.pdf(hrf_times, 16) / 6
+    expected = np.convolve(boxcar, hrf / hrf.sum())[: len(times)][
+        oversampling // 2 :: oversampling
+    ]
+
+    assert design.shape == (n_volumes, 5)
+    assert np.allclose(design[:, 0], expected - expected.mean(), atol=1e-4)
+    model_hrf = modelgen._double_gamma_hrf(time_step)
+    assert np.allclose(model_hrf, hrf / hrf.sum())
+    assert np.isclose(model_hrf.sum(), 1) and hrf_times[np.argmax(model_hrf)] == 5.0
+    # Only the intercept is restored, empty conditions and confounds stay at zero
+    assert np.allclose(design[:, 2], 1)
+    assert np.allclose(design[:, 1], 0) and np.allclose(design[:, 4], 0)
+    assert np.allclose(design[:, 3], np.linspace(-1, 1, n_volumes), atol=1e-5)
+    assert np.array_equal(contrasts, [[1, 0, 0, 0, 0], [0, 1, 0, 0, 0]])
+
+
+def test__detect_outliers(tmp_path, monkeypatch):
+    """Test DetectOutliers flags the intensity outliers rapidart finds."""
+    import warnings
+    import pytest
+    from nipype.interfaces.base import Bunch
+    from nipype.algorithms.rapidart import ArtifactDetect
+    from funcworks.interfaces.modelgen import DetectOutliers
+
+    monkeypatch.chdir(tmp_path)
+    n_volumes = 30
+    data = 100 + np.random.RandomState(0).randn(4, 4, 4, n_volumes).astype(np.float32)
+    data[..., 7] += 8
+    data[..., 20] -= 8
+    nb.save(nb.Nifti1Image(data, np.eye(4)), "bold.nii.gz")
+    nb.save(nb.Nifti1Image(np.full(data.shape, 100, dtype=np.float32), np.eye(4)), "flat.nii.gz")
+    nb.save(nb.Nifti1Image(np.ones(data.shape[:3], dtype=np.uint8), np.eye(4)), "mask.nii.gz")
+    with open("desc-confounds_regressors.tsv", "w") as tsv:
+        tsv.write("framewise_displacement\tstd_dvars\n")
+        tsv.write("n/a\tn/a\n" + "0.1\t1.0\n" * (n_volumes - 1))
+    np.savetxt("motion.par", np.zeros((n_volumes, 6)))
+
+    rapidart = ArtifactDetect(
+        realigned_files="bold.nii.gz",
+        realignment_parameters="motion.par",
+        use_differences=[True, False],
+        use_norm=True,
+        zintensity_threshold=3,
+        norm_threshold=1,
+        bound_by_brainmask=True,
+        mask_type="file",
+        mask_file="mask.nii.gz",
+        parameter_source="FSL",
+    ).run()
+    expected = np.loadtxt(rapidart.outputs.outlier_files, ndmin=1).astype(int)
+
+    def _detect(functional_file, regressor_file="desc-confounds_regressors.tsv"):
+        return DetectOutliers(
+            functional_file=functional_file,
+            mask_file="mask.nii.gz",
+            regressor_file=regressor_file,
+            run_info=Bunch(regressor_names=[], regressors=[]),
+            contrast_entities=[{"DegreesOfFreedom": 20}],
+        ).run()
+
+    result = _detect("bold.nii.gz")
+    assert np.array_equal(np.loadtxt(result.outputs.outlier_file, ndmin=1), expected)
+    assert result.outputs.run_info.regressor_names == ["rapidart00", "rapidart01"]
+    assert result.outputs.contrast_entities["DegreesOfFreedom"] == 20 - len(expected)
+
+    # A constant global signal has no intensity outliers
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        result = _detect("flat.nii.gz")
+    assert np.loadtxt(result.outputs.outlier_file, ndmin=1).size == 0
+
+    # Confounds without framewise displacement cannot flag motion outliers
+    with open("desc-nofd_regressors.tsv", "w") as tsv:
+        tsv.write("std_dvars\n" + "1.0\n" * n_volumes)
+    with pytest.raises(RuntimeError, match="framewise_displacement"):
+        _detect("bold.nii.gz", regressor_file="desc-nofd_regressors.tsv")
+
+
+def test__generate_higher_info_pairs_maps(tmp_path):
+    """Test GenerateHigherInfo pairs effect and variance maps by their entities."""
+    import pytest
+    from types import SimpleNamespace
+    from funcworks.interfaces.modelgen import GenerateHigherInfo
+
+    class _Layout:
+        def get(self, **entities):
+            return [SimpleNamespace(path=str(tmp_path / "mask.nii.gz"))]
+
+    maps, metadata = [], []
+    for stat, run in [("effect", 1), ("effect", 2), ("variance", 2), ("variance", 1)]:
+        maps.append(tmp_path / f"run-{run}_stat-{stat}.nii.gz")
+        maps[-1].touch()
+        metadata.append(
+            {
+                "subject": "01",
+                "task": "test",
+                "run": run,
+                "space": "MNI",
+                "contrast": "trial_type.word",
+                "stat": stat,
+            }
+        )
+        metadata[-1]["DegreesOfFreedom"] = 10 + run
+
+    def _group(maps, metadata):
+        interface = GenerateHigherInfo(
+            contrast_maps=[str(path) for path in maps],
+            contrast_metadata=[entities.copy() for entities in metadata],
+            model={"Level": "subject"},
+            merge_maps=False,
+        )
+        return interface._group_maps(interface._get_organization(), _Layout())
+
+    grouped = _group(maps, metadata)
+    assert [Path(path).name for path in grouped["grouped_effect_maps"][0]] == [
+        "run-1_stat-effect.nii.gz",
+        "run-2_stat-effect.nii.gz",
+    ]
+    assert [Path(path).name for path in grouped["grouped_variance_maps"][0]] == [
+        "run-1_stat-variance.nii.gz",
+        "run-2_stat-variance.nii.gz",
+    ]
+    assert grouped["grouped_dofs"] == [[11, 12]]
+
+    with pytest.raises(ValueError, match="No variance map found"):
+        _group(maps[:3], metadata[:3])
+    with pytest.raises(ValueError, match="No variance maps found"):
+        _group(maps[:2], metadata[:2])
+
+
+def test__generate_higher_info_dof_maps(tmp_path, monkeypatch):
+    """Test GenerateHigherInfo writes one compact DOF map per DOF vector."""
+    from itertools import product
+    from types import SimpleNamespace
+    from funcworks.interfaces.modelgen import GenerateHigherInfo
+
+    class _Layout:
+        def get(self, **entities):
+            return [SimpleNamespace(path=str(tmp_path / "mask.nii.gz"))]
+
+    monkeypatch.chdir(tmp_path)
+    reference = nb.Nifti1Image(np.zeros((3, 4, 5), dtype=np.float32), np.eye(4))
+    maps, metadata = [], []
+    for contrast, stat, run in product(["word", "pseudo"], ["effect", "variance"], [1, 2]):
+        maps.append(str(tmp_path / f"contrast-{contrast}_run-{run}_stat-{stat}.nii.gz"))
+        nb.save(reference, maps[-1])
+        metadata.append(
+            {
+                "subject": "01",
+                "task": "test",
+                "run": run,
+                "space": "MNI",
+                "contrast": f"trial_type.{contrast}",
+                "stat": stat,
+                "DegreesOfFreedom": 10 + run,
+            }
+        )
+
+    interface = GenerateHigherInfo(
+        contrast_maps=maps, contrast_metadata=metadata, model={"Level": "subject"}
+    )
+    outputs = interface._merge_maps(interface._get_organization(), _Layout())
+    dof_maps = outputs[3]
+    assert len(dof_maps) == 2 and dof_maps[0] == dof_maps[1]
+    assert "contrast" not in Path(dof_maps[0]).name
+    dof_image = nb.load(dof_maps[0])
+    assert dof_image.shape == (3, 4, 5, 2)
+    assert dof_image.get_data_dtype() == np.int16
+    for volume, dof in enumerate([11, 12]):
+        assert np.all(np.asanyarray(dof_image.dataobj)[..., volume] == dof)
+
+    dof_file = GenerateHigherInfo._write_dof_map(
+        (10.5, 12.0), reference, str(tmp_path / "float_dof.nii.gz")
+    )
+    dof_image = nb.load(dof_file)
+    assert dof_image.get_data_dtype() == np.float32
+    assert np.allclose(dof_image.get_fdata()[1, 2, 3], [10.5, 12.0])
+
+
+def test__estimate_fixed_effects(tmp_path, monkeypatch):
+    """Test EstimateFixedEffects against the inverse-variance weighted mean."""
+    from funcworks.interfaces.glm import EstimateFixedEffects
+
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.RandomState(0)
+    effects = rng.randn(3, 4, 4, 2)
+    variances = rng.uniform(0.5, 2.0, size=(3, 4, 4, 2))
+    for idx in range(3):
+        nb.save(nb.Nifti1Image(effects[idx].astype(np.float32), np.eye(4)), f"cope{idx}.nii.gz")
+        nb.save(
+            nb.Nifti1Image(variances[idx].astype(np.float32), np.eye(4)), f"varcope{idx}.nii.gz"
+        )
+
+    result = EstimateFixedEffects(
+        effect_maps=[f"cope{idx}.nii.gz" for idx in range(3)],
+        variance_maps=[f"varcope{idx}.nii.gz" for idx in range(3)],
+        dof_values=[20.0, 20.0, 20.0],
+    ).run()
+    weights = 1 / variances.astype(np.float32)
+    expected_variance = 1 / weights.sum(axis=0)
+    expected_effect = (weights * effects.astype(np.float32)).sum(axis=0) * expected_variance
+    copes = nb.load(result.outputs.copes).get_fdata()
+    var_copes = nb.load(result.outputs.var_copes).get_fdata()
+    tstats = nb.load(result.outputs.tstats).get_fdata()
+    assert np.allclose(copes, expected_effect, atol=1e-5)
+    assert np.allclose(var_copes, expected_variance, atol=1e-5)
+    assert np.allclose(tstats, expected_effect / np.sqrt(expected_variance), atol=1e-4)
+
+
+def test__fit_prewhitened():
+    """Test prewhitening brings null z-statistics of AR(1) noise back to unit variance."""
+    from scipy import signal
+    from funcworks.interfaces.glm import _fit_ols, _fit_prewhitened
+
+    noise = signal.lfilter([1], [1, -0.6], np.random.RandomState(0).randn(200, 3000), axis=0)
+    design = np.column_stack([np.tile(np.repeat([0.5, -0.5], 10), 10), np.ones(200)])
+    contrasts = np.array([[1.0, 0.0]])
+
+    def _zstats(copes, varcopes, dof):
+        return utils.t_to_z(copes / np.sqrt(varcopes), dof)
+
+    assert _zstats(*_fit_ols(noise, design, contrasts)).std() > 1.3
+    for autocorr_model in ["tukey", "ar1"]:
+        zstats = _zstats(
+            *_fit_prewhitened(
+                noise, design, contrasts, autocorr_model=autocorr_model, tukey_window=14
+            )
+        )
+        assert 0.9 < zstats.std() < 1.12
+
+
+def test__get_run_model_info(tmp_path, monkeypatch):
+    """Test GetRunModelInfo against per condition filtering of the events."""
+    import json
+    import pandas as pd
+    from funcworks.interfaces import modelgen
+
+    monkeypatch.chdir(tmp_path)
+    model = {
+        "Level": "run",
+        "Model": {"X": ["trial_type.word", "trial_type.pseudo", "framewise_displacement"]},
+        "DummyContrasts": {"Conditions": ["trial_type.word", "trial_type.pseudo"]},
+        "Contrasts": [],
+    }
+    confounds = pd.DataFrame(
+        np.random.RandomState(0).randn(20, 7),
+        columns=modelgen._MOTION_COLUMNS + ["framewise_displacement"],
+    )
+    confounds.loc[0, "framewise_displacement"] = np.nan
+    confounds.to_csv("desc-confounds_regressors.tsv", sep="\t", index=False, na_rep="n/a")
+    (tmp_path / "bold.json").write_text(json.dumps({"RepetitionTime": 2.0}))
+    runs = {
+        "run-1_events.tsv": "onset\tduration\ttrial_type\tamplitude\n"
+        "0\t2\tword\t1\n4\t2\tpseudo\tn/a\n8\t2\tword\tn/a\n12\t2\tn/a\t1\n",
+        "run-2_events.tsv": "onset\tduration\ttrial_type\tamplitude\n"
+        "3\t1\tword\t1\n9\t1\tword\t2\n",
+    }
+
+    for events_file, content in runs.items():
+        (tmp_path / events_file).write_text(content)
+        outputs = (
+            modelgen.GetRunModelInfo(
+                metadata_file="bold.json",
+                regressor_file="desc-confounds_regressors.tsv",
+                events_file=events_file,
+                entities={"subject": "01"},
+                model=model,
+            )
+            .run()
+            .outputs
+        )
+        run_info = outputs.run_info
+
+        event_data = pd.read_csv(events_file, sep="\t")
+        conditions = []
+        for condition in ["word", "pseudo"]:
+            event_frame = event_data.query(f'trial_type == "{condition}"')
+            if event_frame.empty:
+                continue
+            index = len(conditions)
+            conditions.append(f"trial_type.{condition}")
+            assert np.array_equal(run_info.onsets[index], event_frame["onset"].values)
+            assert np.array_equal(run_info.durations[index], event_frame["duration"].values)
+            assert np.array_equal(run_info.amplitudes[index], np.ones(len(event_frame)))
+        assert run_info.conditions == conditions
+        assert outputs.contrast_names == conditions
+        assert run_info.regressor_names == ["framewise_displacement"]
+        assert np.allclose(
+            run_info.regressors[0], confounds["framewise_displacement"].fillna(0).values
+        )
+
+
+def test__bids_get_manifest(tmp_path):
+    """Test BIDSGet returns the same files with and without a manifest."""
+    import json
+    from funcworks.interfaces.bids import BIDSGet
+
+    bids_dir, deriv_dir = tmp_path / "bids", tmp_path / "fmriprep"
+    description = {"Name": "test", "BIDSVersion": "1.4.0"}
+    for root in (bids_dir, deriv_dir):
+        root.mkdir()
+        (root / "dataset_description.json").write_text(json.dumps(description))
+        description = {**description, "PipelineDescription": {"Name": "fmriprep"}}
+    (bids_dir / "task-test_bold.json").write_text(json.dumps({"RepetitionTime": 2.0}))
+    for run in (1, 2):
+        prefix = f"sub-01_task-test_run-{run}"
+        func_dir, deriv_func = bids_dir / "sub-01" / "func", deriv_dir / "sub-01" / "func"
+        func_dir.mkdir(parents=True, exist_ok=True)
+        deriv_func.mkdir(parents=True, exist_ok=True)
+        (func_dir / f"{prefix}_bold.nii.gz").touch()
+        (func_dir / f"{prefix}_events.tsv").write_text("onset\tduration\ttrial_type\n")
+        for name in [
+            "space-MNI_desc-preproc_bold.nii.gz",
+            "space-MNI_desc-brain_mask.nii.gz",
+            "space-MNI_boldref.nii.gz",
+            "desc-confounds_regressors.tsv",
+        ]:
+            (deriv_func / f"{prefix}_{name}").touch()
+        (deriv_func / f"{prefix}_space-MNI_desc-preproc_bold.json").write_text("{}")
+    utils.index_layout(bids_dir, tmp_path / "db", derivatives=[deriv_dir])
+
+    fixed_entities = {"subject": "01", "task": "test"}
+    getter = BIDSGet(database_path=str(tmp_path / "db"), fixed_entities=fixed_entities)
+    expected = getter.run().outputs.get()
+    assert len(expected["functional_files"]) == 2
+    assert [Path(path).name for path in expected["mask_files"]] == [
+        "sub-01_task-test_run-1_space-MNI_desc-brain_mask.nii.gz",
+        "sub-01_task-test_run-2_space-MNI_desc-brain_mask.nii.gz",
+    ]
+
+    manifest_file = utils.write_manifest(
+        utils.load_layout(tmp_path / "db"), fixed_entities, tmp_path / "manifest.json"
+    )
+    # A manifest written for another query is ignored
+    aligned = (
+        BIDSGet(
+            database_path=str(tmp_path / "db"),
+            fixed_entities=fixed_entities,
+            align_volumes=1,
+            manifest_file=manifest_file,
+        )
+        .run()
+        .outputs.get()
+    )
+    assert aligned["functional_files"] == expected["functional_files"]
+    assert aligned["mask_files"] == [expected["mask_files"][0]] * 2
+
+    # A matching manifest answers the query without the database
+    (tmp_path / "db" / "layout_index.sqlite").unlink()
+    getter.inputs.manifest_file = manifest_file
+    assert getter.run().outputs.get() == expected
@@ -48,6 +48,14 @@ def test__reshape_ra():
         assert np.sum(col) == 1
 
 
+def test__image_shape(tmp_path):
+    """Test image_shape."""
+    import nibabel as nb
+
+    nb.save(nb.Nifti1Image(np.zeros((4, 5, 6, 7)), np.eye(4)), str(tmp_path / "test.nii.gz"))
+    assert utils.image_shape(tmp_path / "test.nii.gz") == (4, 5, 6, 7)
+
+
 def test__flatten():
     """Test flatten."""
     input = [[1], [2], [3]]
@@ -64,3 +72,307 @@ def test__correct_matrices():
     matrix_file = curr_dir / "data" / "run0.mat"
     output = utils.correct_matrix(matrix_file)
     assert filecmp.cmp(output, curr_dir / "data" / "run0_corrected.mat")
+
+
+def test__read_vest():
+    """Test read_vest."""
+    curr_dir = Path(__file__).parent
+    matrix, header = utils.read_vest(curr_dir / "data" / "run0.mat")
+    assert matrix.shape == (int(header["NumPoints"][0]), int(header["NumWaves"][0]))
+
+
+def test__write_vest(tmp_path):
+    """Test write_vest."""
+    matrix = np.arange(12, dtype=float).reshape(4, 3)
+    out_file = utils.write_vest(matrix, tmp_path / "design.mat", header={"PPheights": [1, 2, 3]})
+    output, header = utils.read_vest(out_file)
+    assert np.allclose(output, matrix)
+    assert header["NumWaves"] == ["3"] and header["PPheights"] == ["1", "2", "3"]
+
+
+def test__t_to_z():
+    """Test t_to_z."""
+    t_values = np.array([-50.0, -2.0, 0.0, 2.0, 50.0])
+    output = utils.t_to_z(t_values, 1e6)
+    assert np.allclose(output, t_values, atol=1e-3)
+    output = utils.t_to_z(t_values, 10)
+    assert np.allclose(output, -output[::-1])
+    assert np.all(np.abs(output) <= np.abs(t_values))
+
+
+def test__z_to_p():
+    """Test z_to_p."""
+    output = utils.z_to_p(np.array([-1.959964, 0.0, 1.959964]))
+    assert np.allclose(output, [0.975, 0.5, 0.025])
+
+
+def test__load_timeseries(tmp_path):
+    """Test load_timeseries."""
+    import nibabel as nb
+
+    data = np.random.RandomState(0).rand(4, 5, 6, 10).astype(np.float32)
+    mask = np.zeros(data.shape[:3], dtype=np.uint8)
+    mask[1:3, 1:4, 2:5] = 1
+    nb.save(nb.Nifti1Image(data, np.eye(4)), str(tmp_path / "bold.nii.gz"))
+    nb.save(nb.Nifti1Image(mask, np.eye(4)), str(tmp_path / "mask.nii.gz"))
+    np.save(tmp_path / "bold.npy", data[mask > 0].T)
+
+    image_ts, image_mask, _ = utils.load_timeseries(
+        str(tmp_path / "bold.nii.gz"), str(tmp_path / "mask.nii.gz")
+    )
+    matrix_ts, matrix_mask, _ = utils.load_timeseries(
+        str(tmp_path / "bold.npy"), str(tmp_path / "mask.nii.gz")
+    )
+    assert image_ts.shape == (10, mask.sum())
+    assert np.array_equal(image_mask, matrix_mask)
+    assert np.array_equal(image_ts, matrix_ts)
+
+
+def test__smooth_in_mask():
+    """Test smooth_in_mask."""
+    mask = np.zeros((10, 12, 8), dtype=bool)
+    mask[2:8, 3:10, 1:7] = True
+    values = np.full((5, mask.sum()), 3.0, dtype=np.float32)
+    output = utils.smooth_in_mask(values, mask, (2.0, 2.0, 3.0), 6.0, batch_size=2, num_threads=2)
+    assert output.shape == values.shape
+    assert np.allclose(output, 3.0)
+
+    # An impulse spreads with the requested FWHM along every axis
+    zooms, fwhm = np.array([2.0, 2.0, 3.0]), 6.0
+    mask = np.ones((31, 31, 21), dtype=bool)
+    impulse = np.zeros(mask.shape, dtype=np.float64)
+    impulse[15, 15, 10] = 1
+    output = utils.smooth_in_mask(impulse[mask][np.newaxis], mask, zooms, fwhm)
+    kernel = np.zeros(mask.shape)
+    kernel[mask] = output[0]
+    assert np.isclose(kernel.sum(), 1)
+    for axis, (center, zoom) in enumerate(zip((15, 15, 10), zooms)):
+        profile = kernel.sum(axis=tuple(idx for idx in range(3) if idx != axis))
+        positions = (np.arange(len(profile)) - center) * zoom
+        sigma = np.sqrt(np.sum(profile * positions ** 2) / profile.sum())
+        assert np.isclose(sigma * np.sqrt(8 * np.log(2)), fwhm, rtol=0.05)
+
+
+def test__write_volumes(tmp_path):
+    """Test write_volumes."""
+    import pytest
+    import nibabel as nb
+
+    volumes = np.random.RandomState(0).rand(3, 4, 5, 6).astype(np.float32)
+    reference = nb.Nifti1Image(volumes[..., 0], np.diag([2.0, 2.0, 2.0, 1.0]))
+    out_file = utils.write_volumes(
+        (volumes[..., idx] for idx in range(6)), 6, reference, str(tmp_path / "merged.nii.gz")
+    )
+    merged = nb.load(out_file)
+    assert merged.shape == volumes.shape
+    assert np.allclose(merged.affine, reference.affine)
+    assert np.array_equal(merged.get_fdata(dtype=np.float32), volumes)
+
+    # A failed write leaves no truncated image behind
+    for extension in [".nii.gz", ".nii"]:
+        out_file = tmp_path / f"short{extension}"
+        with pytest.raises(ValueError, match="Expected 7 volumes"):
+            utils.write_volumes((volumes[..., idx] for idx in range(6)), 7, reference, out_file)
+        assert not out_file.exists()
+
+
+def test__index_layout(tmp_path):
+    """Test index_layout."""
+    import json
+
+    bids_dir = tmp_path / "bids"
+
+    def _add_subject(subject):
+        func_dir = bids_dir / f"sub-{subject}" / "func"
+        func_dir.mkdir(parents=True)
+        (func_dir / f"sub-{subject}_task-test_bold.nii.gz").write_bytes(b"")
+        (func_dir / f"sub-{subject}_task-test_events.tsv").write_text("onset\tduration\n")
+
+    bids_dir.mkdir()
+    (bids_dir / "dataset_description.json").write_text(
+        json.dumps({"Name": "test", "BIDSVersion": "1.4.0"})
+    )
+    (bids_dir / "task-test_bold.json").write_text(json.dumps({"RepetitionTime": 2.0}))
+    _add_subject("01")
+    layout = utils.index_layout(bids_dir, tmp_path / "db")
+    assert layout.get_subjects() == ["01"]
+
+    _add_subject("02")
+    layout = utils.index_layout(bids_dir, tmp_path / "scoped", participants=["02"])
+    assert layout.get_subjects() == ["02"]
+    layout = utils.index_layout(bids_dir, tmp_path / "db")
+    assert layout.get_subjects() == ["01", "02"]
+    layout = utils.index_layout(bids_dir, tmp_path / "parallel", n_procs=2)
+    assert layout.get_subjects() == ["01", "02"]
+    assert layout.get(subject="02", suffix="bold")[0].get_metadata()["RepetitionTime"] == 2.0
+
+
+def test__index_layout_incremental(tmp_path, monkeypatch):
+    """Test index_layout reindexes only the subjects that changed."""
+    import os
+    import json
+    import sqlite3
+    from contextlib import closing
+    from funcworks.utils import layout as layout_utils
+
+    bids_dir = tmp_path / "bids"
+    bids_dir.mkdir()
+    (bids_dir / "dataset_description.json").write_text(
+        json.dumps({"Name": "test", "BIDSVersion": "1.4.0"})
+    )
+    for subject in ["01", "02", "03"]:
+        func_dir = bids_dir / f"sub-{subject}" / "func"
+        func_dir.mkdir(parents=True)
+        (func_dir / f"sub-{subject}_task-test_bold.nii.gz").write_bytes(b"")
+        (func_dir / f"sub-{subject}_task-test_bold.json").write_text(
+            json.dumps({"RepetitionTime": 2.0})
+        )
+    utils.index_layout(bids_dir, tmp_path / "db")
+
+    def _rows(subject):
+        with closing(sqlite3.connect(str(tmp_path / "db" / "layout_index.sqlite"))) as conn:
+            return {
+                table: sorted(
+                    row
+                    for row in conn.execute(f"SELECT rowid, * FROM {table}")
+                    if any(f"sub-{subject}" in str(value) for value in row)
+                )
+                for table in ["files", "tags", "associations"]
+            }
+
+    indexed = []
+    index_subjects = layout_utils._index_subjects
+
+    def _spy(bids_dir, derivatives, database_path, subjects=None):
+        indexed.append(subjects)
+        index_subjects(bids_dir, derivatives, database_path, subjects)
+
+    monkeypatch.setattr(layout_utils, "_index_subjects", _spy)
+    untouched = {subject: _rows(subject) for subject in ["01", "03"]}
+    sidecar = bids_dir / "sub-02" / "func" / "sub-02_task-test_bold.json"
+    sidecar.write_text(json.dumps({"RepetitionTime": 1.5}))
+    os.utime(sidecar, ns=(0, 10 ** 9))
+    layout = utils.index_layout(bids_dir, tmp_path / "db")
+    assert indexed == [["02"]]
+    assert {subject: _rows(subject) for subject in ["01", "03"]} == untouched
+    bold_file = layout.get(subject="02", suffix="bold", extension="nii.gz")[0]
+    assert bold_file.get_metadata()["RepetitionTime"] == 1.5
+
+    # Without the pybids 0.10 schema the whole dataset is indexed again
+    monkeypatch.setattr("bids.__version__", "0.11.0")
+    indexed.clear()
+    utils.index_layout(bids_dir, tmp_path / "db")
+    assert indexed == []
+    os.utime(sidecar, ns=(0, 2 * 10 ** 9))
+    layout = utils.index_layout(bids_dir, tmp_path / "db")
+    assert indexed == [None]
+    assert layout.get_subjects() == ["01", "02", "03"]
+
+
+def test__load_layout(tmp_path):
+    """Test load_layout."""
+    import os
+    import json
+
+    bids_dir = tmp_path / "bids"
+    func_dir = bids_dir / "sub-01" / "func"
+    func_dir.mkdir(parents=True)
+    (func_dir / "sub-01_task-test_bold.nii.gz").write_bytes(b"")
+    (bids_dir / "dataset_description.json").write_text(
+        json.dumps({"Name": "test", "BIDSVersion": "1.4.0"})
+    )
+    utils.index_layout(bids_dir, tmp_path / "db")
+    layout = utils.load_layout(tmp_path / "db")
+    assert utils.load_layout(str(tmp_path / "db")) is layout
+
+    index_file = tmp_path / "db" / "layout_index.sqlite"
+    mtime_ns = index_file.stat().st_mtime_ns + 10 ** 9
+    os.utime(index_file, ns=(mtime_ns, mtime_ns))
+    reloaded = utils.load_layout(tmp_path / "db")
+    assert reloaded is not layout
+    assert reloaded.get_subjects() == ["01"]
+    assert utils.load_layout(tmp_path / "db") is reloaded
+
+
+def test__load_confounds(tmp_path):
+    """Test load_confounds."""
+    import pytest
+
+    regressor_file = tmp_path / "desc-confounds_regressors.tsv"
+    regressor_file.write_text("trans_x\tframewise_displacement\tcsf\n0.1\tn/a\t3\n0.2\t0.5\t4\n")
+    direct = utils.load_confounds(regressor_file, ["framewise_displacement", "trans_x"])
+    assert list(direct.columns) == ["trans_x", "framewise_displacement"]
+    for _ in range(2):
+        cached = utils.load_confounds(
+            regressor_file, ["framewise_displacement", "trans_x"], cache_dir=tmp_path
+        )
+        assert cached.equals(direct)
+    assert len(list(tmp_path.glob("*/data.npy"))) == 1
+
+    # Text columns are rejected the same way with and without the cache
+    regressor_file = tmp_path / "desc-text_regressors.tsv"
+    regressor_file.write_text("trans_x\tlabel\n0.1\tlow\nn/a\thigh\n")
+    for cache_dir in [None, tmp_path]:
+        with pytest.raises(ValueError, match="not numeric"):
+            utils.load_confounds(regressor_file, ["trans_x", "label"], cache_dir=cache_dir)
+        output = utils.load_confounds(regressor_file, ["trans_x"], cache_dir=cache_dir)
+        assert list(output.columns) == ["trans_x"]
+        assert output["trans_x"].dtype == np.float64 and np.isnan(output["trans_x"][1])
+
+
+def test__parallel_gzip_file(tmp_path):
+    """Test ParallelGzipFile."""
+    import gzip
+    import pytest
+
+    payload = np.random.RandomState(0).bytes(10000)
+    with utils.ParallelGzipFile(tmp_path / "out.gz", num_threads=3, block_size=1000) as fobj:
+        fobj.write(payload[:2500])
+        fobj.seek(2600)
+        fobj.write(payload[2600:])
+    with gzip.open(tmp_path / "out.gz", "rb") as fobj:
+        assert fobj.read() == payload[:2500] + b"\x00" * 100 + payload[2600:]
+
+    with pytest.raises(RuntimeError):
+        with utils.ParallelGzipFile(tmp_path / "failed.gz", block_size=1000) as fobj:
+            fobj.write(payload)
+            raise RuntimeError("write failed")
+    assert not (tmp_path / "failed.gz").exists()
+
+
+def test__convert_nifti(tmp_path):
+    """Test convert_nifti."""
+    import pytest
+    import nibabel as nb
+
+    data = np.arange(60, dtype=np.int16).reshape(3, 4, 5)
+    pair = nb.Nifti1Pair(data, np.diag([2, 2, 2, 1]))
+    pair.header.set_slope_inter(0.5, 1)
+    nb.save(pair, tmp_path / "in.hdr")
+
+    utils.convert_nifti(nb.load(tmp_path / "in.hdr"), tmp_path / "out.nii.gz")
+    single = nb.load(tmp_path / "out.nii.gz")
+    assert isinstance(single, nb.Nifti1Image)
+    assert single.get_data_dtype() == np.int16
+    assert (single.dataobj.slope, single.dataobj.inter) == (0.5, 1)
+    assert np.array_equal(np.asanyarray(single.dataobj), data * 0.5 + 1)
+
+    utils.convert_nifti(single, tmp_path / "back.img")
+    assert (tmp_path / "back.img").read_bytes() == (tmp_path / "in.img").read_bytes()
+
+    (tmp_path / "in.img").write_bytes((tmp_path / "in.img").read_bytes()[:-2])
+    with pytest.raises(ValueError, match="shorter than the 120 bytes"):
+        utils.convert_nifti(nb.load(tmp_path / "in.hdr"), tmp_path / "short.nii")
+    assert not (tmp_path / "short.nii").exists()
+
+
+def test__build_bids_path():
+    """Test build_bids_path."""
+    import pytest
+
+    pattern = "sub-{subject}_[run-{run}_]stat-{stat}_statmap.nii.gz"
+    assert utils.build_bids_path({"subject": "01", "stat": "z"}, pattern) == (
+        "sub-01_stat-z_statmap.nii.gz"
+    )
+    with pytest.raises(ValueError, match="No path pattern matches"):
+        utils.build_bids_path({"subject": "01"}, pattern)
@@ -0,0 +1,102 @@
+"""Tests for workflows."""
+import numpy as np
+import nibabel as nb
+import pytest
+from nipype.interfaces import fsl
+from nipype.utils.filemanip import ensure_list
+from funcworks.workflows.fsl import fsl_run_level_wf, fsl_higher_level_wf
+
+
+def _model():
+    return {
+        "Name": "test_model",
+        "Steps": [
+            {
+                "Level": "run",
+                "Model": {"X": ["trial_type.word", "trans_x"]},
+                "DummyContrasts": {"Conditions": ["trial_type.word"], "Type": "t"},
+                "Contrasts": [],
+            },
+            {"Level": "subject", "DummyContrasts": {"Type": "t"}},
+        ],
+    }
+
+
+@pytest.mark.parametrize(
+    "engine",
+    [
+        pytest.param(
+            "fsl", marks=pytest.mark.skipif(fsl.no_fsl(), reason="FSL is required to build")
+        ),
+        "native",
+    ],
+)
+@pytest.mark.parametrize("uncompressed_work", [False, True])
+def test__uncompressed_work(tmp_path, engine, uncompressed_work):
+    """Test uncompressed_work switches intermediate images, but not sinks, to .nii."""
+    (tmp_path / "db").mkdir()
+    model = _model()
+    workflows = [
+        fsl_run_level_wf(
+            model=model,
+            step=model["Steps"][0],
+            bids_dir=tmp_path,
+            output_dir=tmp_path / "out",
+            work_dir=tmp_path,
+            subject_id="01",
+            database_path=str(tmp_path / "db"),
+            smoothing_fwhm=4,
+            smoothing_level="run",
+            smoothing_type="susan",
+            despike=True,
+            engine=engine,
+            uncompressed_work=uncompressed_work,
+        ),
+        fsl_higher_level_wf(
+            output_dir=tmp_path / "out",
+            work_dir=tmp_path,
+            step=model["Steps"][1],
+            database_path=str(tmp_path / "db"),
+            engine=engine,
+            uncompressed_work=uncompressed_work,
+        ),
+    ]
+    expected = "NIFTI" if uncompressed_work else "NIFTI_GZ"
+    for workflow in workflows:
+        output_types = {}
+        sinks = []
+        for node_name in workflow.list_node_names():
+            node = workflow.get_node(node_name)
+            if isinstance(node.interface, fsl.FEATModel):
+                continue  # Writes design matrices only
+            inputs = node.inputs
+            for trait in ("output_type", "outputtype"):
+                if trait in inputs.copyable_trait_names():
+                    output_types[node_name] = getattr(inputs, trait)
+            if node_name.startswith("ds_"):
+                sinks.extend(ensure_list(inputs.path_patterns))
+        assert output_types and set(output_types.values()) == {expected}, output_types
+        assert sinks and all(pattern.endswith(".nii.gz") for pattern in sinks)
+
+
+def test__sink_compresses_uncompressed_work(tmp_path, monkeypatch):
+    """Test .nii intermediates are gzipped by BIDSDataSink."""
+    from funcworks.interfaces.bids import BIDSDataSink
+    from funcworks.interfaces.glm import ConvertZToP
+
+    monkeypatch.chdir(tmp_path)
+    nb.save(nb.Nifti1Image(np.zeros((2, 2, 2), dtype=np.float32), np.eye(4)), "zstat1.nii")
+    pvals = ConvertZToP(in_files=["zstat1.nii"], output_type="NIFTI").run().outputs.out_files
+    assert pvals[0].endswith("_pval.nii")
+
+    sunk = BIDSDataSink(
+        base_directory=str(tmp_path / "out"),
+        in_file=pvals,
+        entities=[{"subject": "01", "stat": "p"}],
+        path_patterns="sub-{subject}_stat-{stat}_statmap.nii.gz",
+    ).run()
+    out_file = str(sunk.outputs.out_file)
+    assert out_file.endswith("sub-01_stat-p_statmap.nii.gz")
+    with open(out_file, "rb") as fobj:
+        assert fobj.read(2) == b"\x1f\x8b"
+    assert np.allclose(nb.load(out_file).get_fdata(), 0.5)
@@ -7,6 +7,25 @@ from .workflow import (
     correct_matrix,
     flatten,
 )
+from .fsl import read_vest, write_vest
+from .images import (
+    image_shape,
+    load_timeseries,
+    save_masked,
+    write_volumes,
+    convert_nifti,
+    smooth_in_mask,
+)
+from .stats import t_to_z, z_to_p
+from .confounds import load_confounds
+from .compression import OUTPUT_EXTENSIONS, ParallelGzipFile, open_image_file, save_image
+from .layout import (
+    load_layout,
+    index_layout,
+    collect_run_files,
+    write_manifest,
+    build_bids_path,
+)
 
 __all__ = [
     "get_btthresh",
@@ -15,4 +34,24 @@ __all__ = [
     "snake_to_camel",
     "correct_matrix",
     "flatten",
+    "read_vest",
+    "write_vest",
+    "image_shape",
+    "load_timeseries",
+    "save_masked",
+    "write_volumes",
+    "convert_nifti",
+    "smooth_in_mask",
+    "t_to_z",
+    "z_to_p",
+    "load_confounds",
+    "OUTPUT_EXTENSIONS",
+    "ParallelGzipFile",
+    "open_image_file",
+    "save_image",
+    "load_layout",
+    "index_layout",
+    "collect_run_files",
+    "write_manifest",
+    "build_bids_path",
 ]
@@ -0,0 +1,192 @@
+"""Block parallel gzip writing for images produced by funcworks."""
+import io
+import os
+import gzip
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Both can be set in the environment of the workflow, see ``--gzip-level``
+GZIP_LEVEL_VAR = "FUNCWORKS_GZIP_LEVEL"
+GZIP_THREADS_VAR = "FUNCWORKS_GZIP_THREADS"
+# Extensions of the ``output_type`` values shared with nipype's FSL interfaces
+OUTPUT_EXTENSIONS = {"NIFTI": ".nii", "NIFTI_GZ": ".nii.gz"}
+
+
+class ParallelGzipFile(io.RawIOBase):
+    """
+    Write-only gzip file that compresses blocks across a thread pool.
+
+    Every block of ``block_size`` bytes becomes a complete gzip member and
+    members are written in order, the concatenation is a standard gzip file
+    that ``gzip``, ``zlib`` and nibabel read as one stream. zlib releases the
+    GIL while compressing, so blocks are compressed concurrently. When used as
+    a context manager, an exception discards the partial file instead of
+    finishing it.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the file to write
+    compresslevel : int
+        zlib compression level, read from ``FUNCWORKS_GZIP_LEVEL`` (default 1,
+        like nibabel) if not given
+    num_threads : int
+        Number of blocks compressed at once, read from
+        ``FUNCWORKS_GZIP_THREADS`` (default up to 4 CPUs) if not given
+    block_size : int
+        Number of uncompressed bytes per gzip member
+    """
+
+    def __init__(self, filename, compresslevel=None, num_threads=None, block_size=4 << 20):
+        super().__init__()
+        self.name = str(filename)
+        self.compresslevel = (
+            int(os.getenv(GZIP_LEVEL_VAR, 1)) if compresslevel is None else compresslevel
+        )
+        if num_threads is None:
+            num_threads = int(os.getenv(GZIP_THREADS_VAR, min(4, os.cpu_count() or 1)))
+        self.num_threads = max(num_threads, 1)
+        self.block_size = block_size
+        self._fileobj = open(self.name, "wb")
+        self._pool = ThreadPoolExecutor(max_workers=self.num_threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._position = 0
+        self._members = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Move forward by writing zeros, the only seek a stream supports."""
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation(f"Cannot seek from the end of {self.name}")
+        if offset < self._position:
+            raise io.UnsupportedOperation(f"Cannot seek backwards in {self.name}")
+        self.write(b"\x00" * (offset - self._position))
+        return self._position
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(
+            self._pool.submit(_compress_member, block, self.compresslevel)
+        )
+        self._members += 1
+        # Bound memory to a couple of blocks per thread
+        while len(self._pending) > 2 * self.num_threads:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._members:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown()
+            self._fileobj.close()
+            super().close()
+
+    def abort(self):
+        """Close without writing pending members and remove the partial file."""
+        if self.closed:
+            return
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._buffer.clear()
+        try:
+            self._pool.shutdown()
+            self._fileobj.close()
+        finally:
+            super().close()
+            try:
+                os.unlink(self.name)
+            except FileNotFoundError:
+                pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _compress_member(block, compresslevel):
+    """Compress ``block`` into a complete gzip member with a zero timestamp."""
+    # gzip.compress only accepts mtime from Python 3.8 on
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=compresslevel, mtime=0) as member:
+        member.write(block)
+    return buffer.getvalue()
+
+
+@contextmanager
+def open_image_file(out_file):
+    """
+    Open ``out_file`` for writing, with parallel compression if it ends in ``.gz``.
+
+    The partial file is removed if writing fails, so a truncated image is
+    never left behind looking like a finished output.
+    """
+    if str(out_file).endswith(".gz"):
+        with ParallelGzipFile(out_file) as fileobj:
+            yield fileobj
+        return
+    try:
+        with open(out_file, "wb") as fileobj:
+            yield fileobj
+    except BaseException:
+        try:
+            os.unlink(out_file)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def save_image(image, out_file):
+    """
+    Save an image, compressing ``.nii.gz`` outputs with ``ParallelGzipFile``.
+
+    Parameters
+    ----------
+    image : SpatialImage
+        Image to save, e.g. a ``Nifti1Image``
+    out_file : str
+        Path of the image to write
+    Returns
+    -------
+    out_file : str
+        Path of the written image
+    """
+    import nibabel as nb
+
+    out_file = str(out_file)
+    if not out_file.endswith(".nii.gz"):
+        nb.save(image, out_file)
+        return out_file
+    if not isinstance(image, nb.Nifti1Image):
+        image = nb.Nifti1Image.from_image(image)
+    with open_image_file(out_file) as fileobj:
+        image.to_file_map({"image": nb.FileHolder(out_file, fileobj)})
+    return out_file
@@ -0,0 +1,98 @@
+"""Columnar cache of fMRIPrep confounds tables."""
+import json
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+import numpy as np
+
+# Bumped whenever the layout of cache entries changes
+_CACHE_VERSION = 2
+
+
+def load_confounds(regressor_file, columns=None, cache_dir=None):
+    """
+    Load the numeric columns of a confounds TSV.
+
+    With a cache folder the table is parsed once and stored as a column major
+    float64 ``.npy`` matrix, keyed by the path, size and modification time of
+    the TSV. Later calls memory map the matrix and copy only the requested
+    columns, so every model over the same derivatives shares one parse. Both
+    paths parse the table the same way, requesting a column that holds text
+    raises a ``ValueError``.
+
+    Parameters
+    ----------
+    regressor_file : str
+        Tab separated confounds file, ``n/a`` marks missing values
+    columns : iterable
+        Names of the columns to load, all columns if not given. Names that are
+        not in the file are skipped.
+    cache_dir : str
+        Folder holding the converted tables, the TSV is parsed directly if not
+        given
+    Returns
+    -------
+    confounds : DataFrame
+        float64 columns in the order of the file, missing values are NaN
+    """
+    import pandas as pd
+
+    regressor_file = Path(regressor_file).resolve()
+    if columns is not None:
+        columns = set(columns)
+    if cache_dir is None:
+        frame, text_columns = _read_confounds(regressor_file, columns)
+        _check_numeric(regressor_file, text_columns)
+        return frame
+
+    stat = regressor_file.stat()
+    key = hashlib.sha1(
+        f"{regressor_file}\0{stat.st_size}\0{stat.st_mtime_ns}\0{_CACHE_VERSION}".encode()
+    ).hexdigest()
+    entry = Path(cache_dir) / key
+    if not (entry / "columns.json").exists():
+        frame, text_columns = _read_confounds(regressor_file)
+        # Written next to the entry and renamed, concurrent runs never see a partial entry
+        staging = Path(tempfile.mkdtemp(prefix=f".{key}", dir=cache_dir))
+        np.save(staging / "data.npy", np.asfortranarray(frame.values, dtype=np.float64))
+        (staging / "columns.json").write_text(
+            json.dumps({"columns": list(frame.columns), "text_columns": text_columns})
+        )
+        try:
+            staging.rename(entry)
+        except OSError:
+            shutil.rmtree(staging)
+
+    names = json.loads((entry / "columns.json").read_text())
+    _check_numeric(
+        regressor_file,
+        [name for name in names["text_columns"] if columns is None or name in columns],
+    )
+    data = np.load(entry / "data.npy", mmap_mode="r")
+    index = [
+        idx for idx, name in enumerate(names["columns"]) if columns is None or name in columns
+    ]
+    return pd.DataFrame(np.array(data[:, index]), columns=[names["columns"][idx] for idx in index])
+
+
+def _read_confounds(regressor_file, columns=None):
+    """Parse a confounds TSV into its float64 columns and the names of its text columns."""
+    import pandas as pd
+
+    frame = pd.read_csv(
+        regressor_file,
+        sep="\t",
+        usecols=None if columns is None else lambda column: column in columns,
+        na_values="n/a",
+    )
+    text_columns = [
+        column for column in frame.columns if not pd.api.types.is_numeric_dtype(frame[column])
+    ]
+    return frame.drop(columns=text_columns).astype(np.float64), text_columns
+
+
+def _check_numeric(regressor_file, text_columns):
+    """Raise if any of the requested columns holds text."""
+    if text_columns:
+        raise ValueError(f"Confounds {text_columns} of {regressor_file} are not numeric")
@@ -0,0 +1,66 @@
+"""Readers for FSL text matrix files."""
+import numpy as np
+
+
+def read_vest(vest_file):
+    """
+    Read an FSL VEST formatted matrix (e.g. ``.mat`` or ``.con`` files).
+
+    Parameters
+    ----------
+    vest_file : str
+        Path to a design, contrast or covariance matrix written by FSL
+    Returns
+    -------
+    matrix : ndarray
+        Two dimensional array with the contents of the ``/Matrix`` block
+    header : dict
+        Header fields (without the leading slash) mapped to their values
+    """
+    with open(vest_file, "r") as vest_read:
+        content = vest_read.readlines()
+
+    header = {}
+    for idx, line in enumerate(content):
+        if line.startswith("/Matrix"):
+            break
+        if line.startswith("/"):
+            key, *values = line.split()
+            header[key[1:]] = values
+    else:
+        raise ValueError(f"No /Matrix section found in {vest_file}")
+
+    matrix = np.loadtxt(content[idx + 1 :], ndmin=2)
+    return matrix, header
+
+
+def write_vest(matrix, out_file, header=None):
+    """
+    Write a matrix in FSL's VEST format.
+
+    Parameters
+    ----------
+    matrix : array_like
+        Two dimensional array to store in the ``/Matrix`` block
+    out_file : str
+        Path of the file to write
+    header : dict
+        Optional extra header fields mapped to a value or a list of values,
+        written after ``/NumWaves`` and ``/NumPoints`` in insertion order
+    Returns
+    -------
+    out_file : str
+        Path of the written file
+    """
+    matrix = np.atleast_2d(matrix)
+    fields = {"NumWaves": [matrix.shape[1]], "NumPoints": [matrix.shape[0]]}
+    fields.update(header or {})
+    with open(out_file, "w") as vest_write:
+        for key, values in fields.items():
+            if np.isscalar(values):
+                values = [values]
+            vest_write.write("\t".join([f"/{key}"] + [str(value) for value in values]) + "\n")
+        vest_write.write("\n/Matrix\n")
+        for row in matrix:
+            vest_write.write("\t".join(f"{value:e}" for value in row) + "\n")
+    return str(out_file)
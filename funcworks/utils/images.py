@@ -0,0 +1,261 @@
+"""Helpers to move image data in and out of masked voxel matrices."""
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nb
+from nibabel.arrayproxy import is_proxy
+from nibabel.openers import ImageOpener
+from scipy import ndimage
+from .compression import open_image_file, save_image
+
+
+def image_shape(in_file):
+    """Return the shape of an image from its header, without reading the data."""
+    return nb.load(in_file).shape
+
+
+def load_timeseries(in_file, mask_file=None):
+    """
+    Load a 4D image as a (timepoints x voxels) matrix.
+
+    Parameters
+    ----------
+    in_file : str
+        4D image to load, or a ``.npy`` matrix of in-mask voxels as written by
+        ``MaskTimeseries`` which is memory mapped instead of read
+    mask_file : str
+        Optional 3D mask, if not given any voxel that is nonzero at one or more
+        timepoints is kept. Required for ``.npy`` inputs.
+    Returns
+    -------
+    timeseries : ndarray
+        float32 array of shape (timepoints, voxels)
+    mask : ndarray
+        Boolean 3D array marking the voxels in ``timeseries``
+    reference : Nifti1Image
+        Image that supplies geometry for writing results back out
+    """
+    if str(in_file).endswith(".npy"):
+        if mask_file is None:
+            raise ValueError(f"A mask is required to place the voxels of {in_file}")
+        reference = nb.load(mask_file)
+        mask = np.asanyarray(reference.dataobj) > 0
+        timeseries = np.load(in_file, mmap_mode="r")
+        if timeseries.ndim != 2 or timeseries.shape[1] != mask.sum():
+            raise ValueError(
+                f"{in_file} with shape {timeseries.shape} does not match "
+                f"the {mask.sum()} voxels in {mask_file}"
+            )
+        return timeseries, mask, reference
+
+    reference = nb.load(in_file)
+    data = reference.get_fdata(dtype=np.float32)
+    if mask_file is not None:
+        mask = np.asanyarray(nb.load(mask_file).dataobj) > 0
+    else:
+        mask = np.any(data != 0, axis=-1)
+    timeseries = data[mask].T
+    return timeseries, mask, reference
+
+
+def save_masked(values, mask, reference, out_file, fill=0.0):
+    """Write a vector of in-mask values to a 3D float32 image, ``fill`` elsewhere."""
+    volume = np.full(mask.shape, fill, dtype=np.float32)
+    volume[mask] = values
+    header = reference.header.copy()
+    header.set_data_dtype(np.float32)
+    return save_image(nb.Nifti1Image(volume, reference.affine, header), out_file)
+
+
+def write_volumes(volumes, n_volumes, reference, out_file, dtype=np.float32):
+    """
+    Write 3D volumes to a 4D NIfTI image one at a time.
+
+    Volumes are the slowest changing axis of a NIfTI file, so every volume is
+    appended to the (optionally gzipped) file as soon as it is produced and
+    never more than one is held in memory. Gzipped files are compressed by
+    ``ParallelGzipFile``.
+
+    Parameters
+    ----------
+    volumes : iterable
+        3D arrays in the order they should be stored
+    n_volumes : int
+        Number of arrays yielded by ``volumes``
+    reference : Nifti1Image
+        Image whose header and affine provide the geometry of the output
+    out_file : str
+        Path of the image to write, ``.nii`` or ``.nii.gz``
+    dtype : dtype
+        On disk data type of the output
+    Returns
+    -------
+    out_file : str
+        Path of the written image
+    """
+    header = nb.Nifti1Header.from_header(reference.header)
+    header.set_data_shape(tuple(reference.shape[:3]) + (n_volumes,))
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(None, None)
+    header.set_qform(reference.affine, code=int(header["qform_code"]) or 1)
+    header.set_sform(reference.affine, code=int(header["sform_code"]) or 1)
+    header.set_data_offset(header.single_vox_offset + header.extensions.get_sizeondisk())
+    on_disk = header.get_data_dtype()
+
+    written = 0
+    with open_image_file(out_file) as image_file:
+        header.write_to(image_file)
+        image_file.write(b"\x00" * (header.get_data_offset() - image_file.tell()))
+        for volume in volumes:
+            if volume.shape != reference.shape[:3]:
+                raise ValueError(
+                    f"Volume with shape {volume.shape} does not match {reference.shape[:3]}"
+                )
+            image_file.write(np.asarray(volume, dtype=on_disk).tobytes(order="F"))
+            written += 1
+        if written != n_volumes:
+            raise ValueError(f"Expected {n_volumes} volumes for {out_file}, got {written}")
+    return str(out_file)
+
+
+def convert_nifti(image, out_file, block_size=4 << 20):
+    """
+    Rewrite a NIfTI image as a single file or a header/image pair without decoding it.
+
+    The two layouts differ only in the magic string and data offset of the
+    header, so the header is copied with those two fields changed and the raw
+    data bytes are streamed across in blocks. Data type, byte order and
+    scaling are kept, either side may be gzipped.
+
+    Parameters
+    ----------
+    image : Nifti1Pair
+        NIfTI-1 or NIfTI-2 image loaded from disk, single file or pair
+    out_file : str
+        Path of the image to write, ``.nii`` or ``.nii.gz`` for a single file,
+        otherwise the ``.hdr`` or ``.img`` (optionally ``.gz``) name of a pair
+    block_size : int
+        Number of bytes copied at a time
+    Returns
+    -------
+    out_file : str
+        Path of the written image
+    """
+    if not isinstance(image, nb.Nifti1Pair):
+        raise ValueError(f"Expected a NIfTI image, got {type(image).__name__}")
+    if not is_proxy(image.dataobj):
+        raise ValueError("Only images loaded from disk can be streamed, use save_image instead")
+
+    single = str(out_file).lower().endswith((".nii", ".nii.gz"))
+    if isinstance(image.header, nb.Nifti2Header):
+        klass = nb.Nifti2Image if single else nb.Nifti2Pair
+    else:
+        klass = nb.Nifti1Image if single else nb.Nifti1Pair
+    # Loaded headers have their scaling moved to the array proxy, start from the one on disk
+    holders = image.file_map
+    with holders.get("header", holders["image"]).get_prepare_fileobj("rb") as in_fobj:
+        on_disk = image.header_class.from_fileobj(in_fobj, check=False)
+    header = klass.header_class(
+        on_disk.binaryblock,
+        endianness=on_disk.endianness,
+        check=False,
+        extensions=on_disk.extensions,
+    )
+    header["magic"] = header.single_magic if single else header.pair_magic
+    header.set_data_offset(
+        header.single_vox_offset + header.extensions.get_sizeondisk() if single else 0
+    )
+    proxy = image.dataobj
+    n_bytes = int(np.prod(proxy.shape)) * proxy.dtype.itemsize
+
+    file_map = klass.filespec_to_file_map(str(out_file))
+    data_file = file_map["image"].filename
+    header_file = file_map["header"].filename if "header" in file_map else data_file
+    try:
+        with ImageOpener(proxy.file_like) as in_fobj:
+            in_fobj.seek(proxy.offset)
+            with open_image_file(header_file) as out_fobj:
+                header.write_to(out_fobj)
+                if single:
+                    out_fobj.write(b"\x00" * (header.get_data_offset() - out_fobj.tell()))
+                    _copy_bytes(in_fobj, out_fobj, n_bytes, block_size)
+            if not single:
+                with open_image_file(data_file) as out_fobj:
+                    _copy_bytes(in_fobj, out_fobj, n_bytes, block_size)
+    except EOFError as err:
+        for path in {header_file, data_file}:
+            try:
+                Path(path).unlink()
+            except FileNotFoundError:
+                pass
+        raise ValueError(
+            f"{proxy.file_like} is shorter than the {n_bytes} bytes of {proxy.dtype} data "
+            f"with shape {proxy.shape} declared by its header: {err}"
+        ) from None
+    return str(out_file)
+
+
+def _copy_bytes(in_fobj, out_fobj, n_bytes, block_size):
+    """Copy exactly ``n_bytes`` bytes, raising ``EOFError`` if the input ends first."""
+    remaining = n_bytes
+    while remaining:
+        block = in_fobj.read(min(block_size, remaining))
+        if not block:
+            raise EOFError(f"{n_bytes - remaining} bytes read")
+        out_fobj.write(block)
+        remaining -= len(block)
+
+
+def smooth_in_mask(values, mask, zooms, fwhm, batch_size=16, num_threads=1):
+    """
+    Gaussian smooth rows of in-mask values without mixing in outside voxels.
+
+    The kernel is applied as three separable 1D convolutions to batches of
+    volumes at a time and renormalized by the smoothed mask, so voxels near the
+    edge of the mask are averages of in-mask voxels only.
+
+    Parameters
+    ----------
+    values : ndarray
+        Array of shape (volumes, voxels) ordered like ``data[mask]``
+    mask : ndarray
+        Boolean 3D mask the columns of ``values`` belong to
+    zooms : sequence
+        Voxel sizes in mm along the three spatial axes
+    fwhm : float
+        Full width at half maximum of the kernel in mm
+    batch_size : int
+        Number of volumes filtered together
+    num_threads : int
+        Number of batches filtered concurrently
+    Returns
+    -------
+    smoothed : ndarray
+        Array with the shape of ``values``, float32 unless values are float64
+    """
+    dtype = np.result_type(values.dtype, np.float32)
+    sigmas = fwhm / np.sqrt(8 * np.log(2)) / np.asarray(zooms, dtype=np.float64)
+
+    def _filter(volumes):
+        for axis, sigma in enumerate(sigmas):
+            if sigma > 0:
+                ndimage.gaussian_filter1d(volumes, sigma, axis=axis, output=volumes)
+        return volumes
+
+    weights = _filter(mask.astype(dtype))[mask]
+    smoothed = np.empty(values.shape, dtype=dtype)
+
+    def _smooth_batch(start):
+        rows = values[start : start + batch_size]
+        volumes = np.zeros(mask.shape + (len(rows),), dtype=dtype)
+        volumes[mask] = rows.T
+        smoothed[start : start + batch_size] = (_filter(volumes)[mask] / weights[:, None]).T
+
+    starts = range(0, values.shape[0], batch_size)
+    if num_threads > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            list(pool.map(_smooth_batch, starts))
+    else:
+        for start in starts:
+            _smooth_batch(start)
+    return smoothed
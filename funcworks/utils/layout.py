@@ -0,0 +1,475 @@
+"""Helpers to index BIDS datasets and reuse layouts across nodes of the same process."""
+import os
+import re
+import json
+import shutil
+import sqlite3
+import hashlib
+from fnmatch import fnmatch
+from itertools import repeat
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+_LAYOUT_CACHE = {}
+_FINGERPRINT_FILE = "funcworks_fingerprint.json"
+# Dataset level files that nothing inherits from, they are refreshed in place
+_LOOSE_FILES = ("participants.*", "README*", "CHANGES", "*.html")
+_SKIPPED_DIRS = ("code", "stimuli", "sourcedata", "models", "derivatives")
+
+
+def load_layout(database_path):
+    """
+    Load a BIDSLayout from a database, once per process.
+
+    Layouts are cached by the resolved database path and reloaded only when
+    the index or its arguments change on disk. MultiProc workers are
+    recycled after every task, so light nodes calling this are run without
+    submitting to share the cache of the main process.
+
+    Parameters
+    ----------
+    database_path : str
+        Folder holding the ``layout_index.sqlite`` index written by pybids
+    Returns
+    -------
+    layout : BIDSLayout
+        Layout backed by the database
+    """
+    from bids import BIDSLayout
+
+    database_path = Path(database_path).resolve()
+    stamp = tuple(
+        path.stat().st_mtime_ns if path.exists() else None
+        for path in (database_path / "layout_index.sqlite", database_path / "layout_args.json")
+    )
+    cached = _LAYOUT_CACHE.get(database_path)
+    if cached is None or cached[0] != stamp:
+        cached = (stamp, BIDSLayout.load(str(database_path)))
+        _LAYOUT_CACHE[database_path] = cached
+    return cached[1]
+
+
+def collect_run_files(layout, fixed_entities, align_volumes=None):
+    """
+    Find the preprocessed functional runs and their companion files.
+
+    All files of the subject are fetched in a single query and companions are
+    matched in memory against an index keyed on the constrained entities.
+
+    Parameters
+    ----------
+    layout : BIDSLayout
+        Layout to query
+    fixed_entities : dict
+        Entities every functional run has to match
+    align_volumes : int
+        Run whose mask and reference are used for every run
+    Returns
+    -------
+    run_files : dict
+        Lists of paths for ``functional_files``, ``mask_files``,
+        ``reference_files``, ``metadata_files``, ``events_files`` and
+        ``regressor_files`` and the ``entities`` of each run
+    """
+    functional_entities = {
+        **fixed_entities,
+        "datatype": "func",
+        "desc": "preproc",
+        "extension": "nii.gz",
+        "suffix": "bold",
+    }
+    functional_files = layout.get(**functional_entities)
+    if len(functional_files) == 0:
+        raise FileNotFoundError(
+            f"Unable to find functional image with " f"specified entities {functional_entities}"
+        )
+
+    # Companions of every run are resolved from one query per subject,
+    # indexed by the values of the entities each lookup constrains.
+    functional_ents = [layout.parse_file_entities(file.path) for file in functional_files]
+    candidates = [
+        (candidate, layout.parse_file_entities(candidate.path))
+        for subject in sorted({str(ents.get("subject")) for ents in functional_ents})
+        for candidate in layout.get(subject=subject)
+    ]
+    indexes = {}
+
+    def _match(entities):
+        keys = tuple(sorted(entities))
+        if keys not in indexes:
+            indexes[keys] = {}
+            for candidate, candidate_ents in candidates:
+                indexes[keys].setdefault(_entity_key(candidate_ents, keys), []).append(candidate)
+        return indexes[keys].get(_entity_key(entities, keys), [])
+
+    run_files = dict(
+        functional_files=[file.path for file in functional_files],
+        mask_files=[],
+        reference_files=[],
+        events_files=[],
+        metadata_files=[],
+        regressor_files=[],
+        entities=[],
+    )
+    for file, ents in zip(functional_files, functional_ents):
+        if "space" not in ents:
+            ents["space"] = None
+        file_ents = dict(
+            events={**ents, "desc": None, "extension": "tsv", "suffix": "events", "space": None},
+            metadata={**ents, "extension": "json"},
+            regressor={
+                **ents,
+                "desc": "confounds",
+                "space": None,
+                "suffix": "regressors",
+                "extension": "tsv",
+            },
+            mask={**ents, "desc": "brain", "suffix": "mask"},
+            reference={**ents, "suffix": "boldref", "desc": None},
+        )
+        if align_volumes and "run" not in ents:
+            raise ValueError(
+                f"Attempted to align to when run entity is not present in " f"{file.path}."
+            )
+        elif align_volumes:
+            file_ents["mask"]["run"] = align_volumes
+            file_ents["reference"]["run"] = align_volumes
+
+        ents.pop("suffix", None)
+        ents.pop("desc", None)
+        run_files["entities"].append(ents)
+        for filetype, entities in file_ents.items():
+            files = _match(entities)
+            if len(files) > 1:
+                raise ValueError(
+                    f"More than one {filetype} produced for given "
+                    f"entities {entities}\n"
+                    f"{[x.path for x in files]}"
+                    f"{ents}"
+                )
+            elif len(files) == 0:
+                raise FileNotFoundError(f"No {filetype} found for given entities " f"{entities}")
+            else:
+                run_files[f"{filetype}_files"].append(files[0].path)
+    return run_files
+
+
+def write_manifest(layout, fixed_entities, out_file, align_volumes=None):
+    """
+    Resolve the run files of a query once and store them as JSON.
+
+    The manifest records the query it answers so ``BIDSGet`` can check that it
+    still applies before skipping the database.
+
+    Parameters
+    ----------
+    layout : BIDSLayout
+        Layout to query
+    fixed_entities : dict
+        Entities every functional run has to match
+    out_file : str
+        Path of the manifest to write
+    align_volumes : int
+        Run whose mask and reference are used for every run
+    Returns
+    -------
+    out_file : str
+        Path of the written manifest
+    """
+    manifest = {
+        "fixed_entities": fixed_entities,
+        "align_volumes": align_volumes,
+        **collect_run_files(layout, fixed_entities, align_volumes=align_volumes),
+    }
+    Path(out_file).parent.mkdir(exist_ok=True, parents=True)
+    Path(out_file).write_text(json.dumps(manifest, indent=2))
+    return str(out_file)
+
+
+def build_bids_path(entities, path_patterns):
+    """
+    Build a file name from entities, like pybids' ``build_path``.
+
+    Parameters
+    ----------
+    entities : dict
+        Entities to fill the patterns with
+    path_patterns : str or list
+        Patterns tried in order, the first one all required entities match is used
+    Returns
+    -------
+    path : str
+        Relative path built from the first matching pattern
+    """
+    from bids.layout.writing import build_path
+
+    path = build_path(entities, path_patterns=path_patterns)
+    if path is None:
+        raise ValueError(f"No path pattern matches entities {entities}, patterns: {path_patterns}")
+    return path
+
+
+def _entity_key(entities, keys):
+    """Return the hashable values of ``keys``, ``None`` marks an absent entity."""
+    return tuple(None if entities.get(key) is None else str(entities[key]) for key in keys)
+
+
+def index_layout(
+    bids_dir, database_path, derivatives=None, participants=None, reset_database=False, n_procs=1
+):
+    """
+    Index a dataset into ``database_path``, reusing what is still current.
+
+    Every file is fingerprinted by its size and modification time. When
+    nothing changed the existing index is loaded, when only subject folders
+    (or loose top level files like ``participants.tsv``) changed those
+    subjects are indexed on their own and merged into the existing database.
+    Anything else, like an edited top level sidecar, triggers a full index.
+    Merging relies on the database schema of pybids 0.10, with any other
+    version the whole dataset is indexed again when anything changed.
+
+    With ``participants`` only their folders and the dataset level files are
+    walked and indexed. Participants requested by later calls are added to the
+    same database as they are needed.
+
+    Subjects are walked, validated and have their sidecars parsed in separate
+    processes, each one writes a scratch database that is merged into the
+    final one.
+
+    Parameters
+    ----------
+    bids_dir : str
+        Root of the raw BIDS dataset
+    database_path : str
+        Folder holding the database of the layout and its derivatives
+    derivatives : list
+        Folders of preprocessed derivatives to index along with the dataset
+    participants : list
+        Labels of the subjects to index, all subjects if not given
+    reset_database : bool
+        Index the whole dataset even if parts of the database are current
+    n_procs : int
+        Number of processes indexing groups of subjects at the same time
+    Returns
+    -------
+    layout : BIDSLayout
+        Layout backed by the database
+    """
+    from bids import BIDSLayout
+
+    bids_dir = str(Path(bids_dir).resolve())
+    derivatives = [str(Path(path).resolve()) for path in derivatives or []]
+    database_path = Path(database_path).resolve()
+    fingerprint_file = database_path / _FINGERPRINT_FILE
+    if participants is not None:
+        participants = sorted({str(label).replace("sub-", "", 1) for label in participants})
+    state = {
+        "bids_dir": bids_dir,
+        "derivatives": derivatives,
+        "participants": participants,
+        "fingerprints": {
+            root: _fingerprint_root(
+                root, skip=_SKIPPED_DIRS if root == bids_dir else (), subjects=participants
+            )
+            for root in [bids_dir] + derivatives
+        },
+    }
+
+    previous = None
+    if (
+        not reset_database
+        and fingerprint_file.exists()
+        and (database_path / "layout_index.sqlite").exists()
+    ):
+        previous = json.loads(fingerprint_file.read_text())
+    subjects = _changed_subjects(previous, state)
+    mergeable = _can_merge_index()
+
+    if subjects is None or (subjects and not mergeable):
+        try:
+            fingerprint_file.unlink()
+        except FileNotFoundError:
+            pass
+        if n_procs > 1 and mergeable:
+            # Index the dataset level files alone, then subjects in parallel
+            _index_subjects(bids_dir, derivatives, database_path, [])
+            subjects = {
+                subject
+                for fingerprint in state["fingerprints"].values()
+                for subject in fingerprint["subjects"]
+            }
+        else:
+            _index_subjects(bids_dir, derivatives, database_path, participants)
+            subjects = set()
+    else:
+        # Subjects indexed before but not requested now stay as they were
+        if participants is not None:
+            for root, fingerprint in state["fingerprints"].items():
+                fingerprint["subjects"] = {
+                    **{
+                        subject: digest
+                        for subject, digest in previous["fingerprints"][root]["subjects"].items()
+                        if subject not in participants
+                    },
+                    **fingerprint["subjects"],
+                }
+            if previous.get("participants") is not None:
+                state["participants"] = sorted(set(previous["participants"]) | set(participants))
+            else:
+                state["participants"] = None
+    if subjects:
+        _update_index(bids_dir, derivatives, database_path, subjects, n_procs)
+
+    fingerprint_file.write_text(json.dumps(state))
+    return BIDSLayout.load(str(database_path))
+
+
+def _can_merge_index():
+    """Merging writes to the tables of pybids 0.10 databases, other versions are reindexed."""
+    import bids
+
+    return bids.__version__.startswith("0.10.")
+
+
+def _index_subjects(bids_dir, derivatives, database_path, subjects=None):
+    """Index the dataset level files and ``subjects`` (all if ``None``) into a new database."""
+    from bids import BIDSLayout
+
+    ignore = list(BIDSLayout._default_ignore)
+    if subjects is not None:
+        ignore.append(_other_subjects_regex(subjects))
+    BIDSLayout(
+        bids_dir,
+        derivatives=derivatives or False,
+        validate=True,
+        ignore=ignore,
+        database_path=str(database_path),
+        reset_database=True,
+    )
+
+
+def _update_index(bids_dir, derivatives, database_path, subjects, n_procs=1):
+    """Index ``subjects`` in groups across processes and merge them into the database."""
+    labels = sorted(subjects - {None})
+    groups = [labels[start::n_procs] for start in range(min(n_procs, len(labels)))] or [[]]
+    scratch_path = database_path / ".incremental"
+    shutil.rmtree(scratch_path, ignore_errors=True)
+    fresh_paths = [scratch_path / str(idx) for idx in range(len(groups))]
+    if len(groups) > 1:
+        with ProcessPoolExecutor(max_workers=len(groups)) as pool:
+            list(
+                pool.map(
+                    _index_subjects, repeat(bids_dir), repeat(derivatives), fresh_paths, groups
+                )
+            )
+    else:
+        _index_subjects(bids_dir, derivatives, fresh_paths[0], groups[0])
+
+    indexes = [
+        index.parent
+        for index in database_path.glob("**/layout_index.sqlite")
+        if scratch_path not in index.parents
+    ]
+    for fresh_path, group in zip(fresh_paths, groups):
+        for index_path in indexes:
+            _merge_index(
+                index_path,
+                fresh_path / index_path.relative_to(database_path),
+                set(group) | (subjects & {None}),
+            )
+    shutil.rmtree(scratch_path)
+
+
+def _subject_of(relpath):
+    """Return the label of the subject a path belongs to, ``None`` if dataset level."""
+    for part in Path(relpath).parts:
+        match = re.match(r"sub-([a-zA-Z0-9]+)(?:[._]|$)", part)
+        if match:
+            return match.group(1)
+    return None
+
+
+def _other_subjects_regex(subjects):
+    """Match the folders and top level files of every subject not in ``subjects``."""
+    labels = "|".join(re.escape(subject) for subject in sorted(subjects))
+    return re.compile(rf"/sub-(?!(?:{labels})(?:[._]|$))[a-zA-Z0-9]+(?:[._][^/]*)?$")
+
+
+def _fingerprint_root(root, skip=(), subjects=None):
+    """Hash the relative path, size and mtime of every file, grouped by subject."""
+
+    def _in_scope(name):
+        return subjects is None or _subject_of(name) in (None, *subjects)
+
+    digests = {}
+    dataset = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root:
+            dirnames[:] = [name for name in dirnames if name not in skip]
+        dirnames[:] = sorted(
+            name for name in dirnames if not name.startswith(".") and _in_scope(name)
+        )
+        for filename in sorted(filter(_in_scope, filenames)):
+            relpath = os.path.relpath(os.path.join(dirpath, filename), root)
+            stat = os.stat(os.path.join(dirpath, filename))
+            subject = _subject_of(relpath)
+            if subject is None:
+                dataset[relpath] = f"{stat.st_size}:{stat.st_mtime_ns}"
+            else:
+                digests.setdefault(subject, hashlib.sha1()).update(
+                    f"{relpath}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode()
+                )
+    return {
+        "dataset": dataset,
+        "subjects": {subject: digest.hexdigest() for subject, digest in digests.items()},
+    }
+
+
+def _changed_subjects(previous, current):
+    """Return the subjects to reindex, ``None`` if the whole dataset has to be."""
+    if previous is None or any(
+        previous[key] != current[key] for key in ("bids_dir", "derivatives")
+    ):
+        return None
+    scope = current["participants"]
+    changed = set()
+    for root, fingerprint in current["fingerprints"].items():
+        old = previous["fingerprints"][root]
+        for relpath in set(old["dataset"]) | set(fingerprint["dataset"]):
+            if old["dataset"].get(relpath) != fingerprint["dataset"].get(relpath):
+                if not any(fnmatch(Path(relpath).name, patt) for patt in _LOOSE_FILES):
+                    return None
+                changed.add(None)
+        for subject in set(old["subjects"]) | set(fingerprint["subjects"]):
+            if scope is not None and subject not in scope:
+                continue
+            if old["subjects"].get(subject) != fingerprint["subjects"].get(subject):
+                changed.add(subject)
+    return changed
+
+
+def _merge_index(database_path, fresh_path, subjects):
+    """Replace the rows of ``subjects`` in a layout database with freshly indexed ones."""
+    root = json.loads((database_path / "layout_args.json").read_text())["root"]
+
+    def _is_stale(path):
+        subject = _subject_of(os.path.relpath(path, root))
+        if subject is None:
+            name = Path(path).name
+            return None in subjects and any(fnmatch(name, patt) for patt in _LOOSE_FILES)
+        return subject in subjects
+
+    with closing(sqlite3.connect(str(database_path / "layout_index.sqlite"))) as conn:
+        conn.execute("ATTACH DATABASE ? AS fresh", (str(fresh_path / "layout_index.sqlite"),))
+        stale = [(path,) for (path,) in conn.execute("SELECT path FROM files") if _is_stale(path)]
+        conn.executemany("DELETE FROM tags WHERE file_path = ?", stale)
+        conn.executemany("DELETE FROM associations WHERE src = ?", stale)
+        conn.executemany("DELETE FROM associations WHERE dst = ?", stale)
+        conn.executemany("DELETE FROM files WHERE path = ?", stale)
+        conn.execute("INSERT OR IGNORE INTO entities SELECT * FROM fresh.entities")
+        conn.execute("INSERT OR REPLACE INTO files SELECT * FROM fresh.files")
+        conn.execute("INSERT OR REPLACE INTO tags SELECT * FROM fresh.tags")
+        conn.execute("INSERT OR IGNORE INTO associations SELECT * FROM fresh.associations")
+        conn.commit()
+        conn.execute("DETACH DATABASE fresh")
@@ -0,0 +1,24 @@
+"""Statistical conversions shared by the native estimation interfaces."""
+import numpy as np
+from scipy import stats
+
+
+def t_to_z(t_values, dof):
+    """
+    Convert t statistics to z statistics with matching tail probabilities.
+
+    Conversion is done through the upper tail of ``|t|`` to keep precision for
+    large statistics, where the probability underflows the t value is kept.
+    """
+    t_values = np.asarray(t_values, dtype=np.float64)
+    p_values = stats.t.sf(np.abs(t_values), dof)
+    with np.errstate(over="ignore", invalid="ignore"):
+        z_values = np.sign(t_values) * stats.norm.isf(p_values)
+    extreme = ~np.isfinite(z_values)
+    z_values[extreme] = t_values[extreme]
+    return z_values
+
+
+def z_to_p(z_values):
+    """Convert z statistics to one-tailed (upper) p-values like ``fslmaths -ztop``."""
+    return stats.norm.sf(z_values)
@@ -33,20 +33,18 @@ def reshape_ra(run_info, functional_file, outlier_file, contrast_entities):
               timepoints
     contrast_entities: Updated contrast entities with new DegreesOfFreedom
     """
-    import pandas as pd
+    from pathlib import Path
     import numpy as np
-    import nibabel as nb
     from nipype.interfaces.base import Bunch
+    from funcworks.utils import image_shape
 
     run_dict = run_info.dictcopy()
-    ntimepoints = nb.load(functional_file).get_fdata().shape[-1]
-    outlier_frame = pd.read_csv(outlier_file, header=None, names=["outlier_index"])
-    outlier_frame["outlier_index"] = outlier_frame["outlier_index"].astype(int)
-    for i, row in outlier_frame.iterrows():
-        run_dict["regressor_names"].append(f"rapidart{i:02d}")
-        ra_col = np.zeros(ntimepoints)
-        ra_col[row["outlier_index"]] = 1
-        run_dict["regressors"].append(ra_col)
+    ntimepoints = image_shape(functional_file)[-1]
+    outlier_indices = np.array(Path(outlier_file).read_text().split(), dtype=float).astype(int)
+    spikes = np.zeros((len(outlier_indices), ntimepoints))
+    spikes[np.arange(len(outlier_indices)), outlier_indices] = 1
+    run_dict["regressor_names"].extend(f"rapidart{i:02d}" for i in range(len(outlier_indices)))
+    run_dict["regressors"].extend(spikes)
     run_info = Bunch(**run_dict)
 
     contrast_ents = contrast_entities.copy()
@@ -54,7 +52,7 @@ def reshape_ra(run_info, functional_file, outlier_file, contrast_entities):
     for ents in contrast_ents:
         cont_ents = ents.copy()
         curr_dof = cont_ents["DegreesOfFreedom"]
-        cont_ents.update({"DegreesOfFreedom": curr_dof - len(outlier_frame)})
+        cont_ents.update({"DegreesOfFreedom": curr_dof - len(outlier_indices)})
         contrast_entities.append(cont_ents)
     return run_info, contrast_entities
 
@@ -21,6 +21,9 @@ def init_funcworks_wf(
     align_volumes,
     smooth_autocorrelations,
     despike,
+    engine="fsl",
+    manifests=None,
+    uncompressed_work=False,
 ):
     """Initialize funcworks single subject workflow for all subjects."""
     with open(model_file, "r") as read_mdl:
@@ -38,6 +41,8 @@ def init_funcworks_wf(
             smoothing_params.append("iso")
         smoothing_fwhm, smoothing_level, smoothing_type = smoothing_params
         smoothing_fwhm = int(smoothing_fwhm)
+        if smoothing_type not in ("iso", "susan", "inp"):
+            raise ValueError(f"Invalid smoothing type {smoothing_type}")
 
         if smoothing_level.lower().startswith("l"):
             if int(smoothing_level[1:]) > len(model["Steps"]):
@@ -64,6 +69,9 @@ def init_funcworks_wf(
             align_volumes=align_volumes,
             smooth_autocorrelations=smooth_autocorrelations,
             despike=despike,
+            engine=engine,
+            manifest_file=(manifests or {}).get(subject_id),
+            uncompressed_work=uncompressed_work,
             name=f"single_subject_{subject_id}_wf",
         )
         crash_dir = (
@@ -103,6 +111,9 @@ def init_funcworks_subject_wf(
     smooth_autocorrelations,
     despike,
     name,
+    engine="fsl",
+    manifest_file=None,
+    uncompressed_work=False,
 ):
     """Produce single subject workflow for a subject given a model spec."""
     workflow = Workflow(name=name)
@@ -127,6 +138,9 @@ def init_funcworks_subject_wf(
                 align_volumes=align_volumes,
                 smooth_autocorrelations=smooth_autocorrelations,
                 despike=despike,
+                engine=engine,
+                manifest_file=manifest_file,
+                uncompressed_work=uncompressed_work,
                 name=f"fsl_{level}_level_wf",
             )
             workflow.add_nodes([model])
@@ -140,6 +154,8 @@ def init_funcworks_subject_wf(
                 smoothing_level=smoothing_level,
                 # smoothing_type=smoothing_type,
                 align_volumes=align_volumes,
+                engine=engine,
+                uncompressed_work=uncompressed_work,
                 name=f"fsl_{level}_level_wf",
             )
             workflow.connect(
@@ -8,7 +8,19 @@ from nipype.interfaces.utility import Function, IdentityInterface, Merge
 from nipype.algorithms import modelgen, rapidart as ra
 from ..interfaces.bids import BIDSGet, BIDSDataSink
 from ..interfaces.fsl import ApplyMask
-from ..interfaces.modelgen import GetRunModelInfo, GenerateHigherInfo
+from ..interfaces.glm import EstimateRunModel, EstimateFixedEffects, ConvertZToP
+from ..interfaces.preprocess import (
+    MaskTimeseries,
+    SusanStatistics,
+    SusanSmooth,
+    IsotropicSmooth,
+)
+from ..interfaces.modelgen import (
+    GetRunModelInfo,
+    DetectOutliers,
+    GenerateRunDesign,
+    GenerateHigherInfo,
+)
 from ..interfaces.io import MergeAll, CollateWithMetadata
 from ..interfaces.visualization import PlotMatrices
 from .. import utils
@@ -30,12 +42,18 @@ def fsl_run_level_wf(
     align_volumes=None,
     smooth_autocorrelations=False,
     despike=False,
+    engine="fsl",
+    manifest_file=None,
+    uncompressed_work=False,
     name="fsl_run_level_wf",
 ):
     """Generate run level workflow for a given model."""
     bids_dir = Path(bids_dir)
     work_dir = Path(work_dir)
     workflow = pe.Workflow(name=name)
+    # Intermediate images stay uncompressed (and memory mappable) if requested,
+    # the data sinks compress them on the way to the output directory
+    output_type = "NIFTI" if uncompressed_work else "NIFTI_GZ"
 
     level = step["Level"]
 
@@ -58,21 +76,29 @@ def fsl_run_level_wf(
             fixed_entities=include_entities,
             align_volumes=align_volumes,
         ),
+        # Runs in the main process to reuse the layout cached by load_layout
+        run_without_submitting=True,
         name="func_select",
     )
+    if manifest_file:
+        getter.inputs.manifest_file = manifest_file
+
+    # Confounds are converted once and shared by every model in the working directory
+    confounds_cache = work_dir / "confounds_cache"
+    confounds_cache.mkdir(exist_ok=True)
 
     get_info = pe.MapNode(
-        GetRunModelInfo(model=step, detrend_poly=detrend_poly),
+        GetRunModelInfo(model=step, detrend_poly=detrend_poly, cache_dir=str(confounds_cache)),
         iterfield=["metadata_file", "regressor_file", "events_file", "entities"],
         name=f"get_{level}_info",
     )
 
     despiker = pe.MapNode(
-        afni.Despike(outputtype="NIFTI_GZ"), iterfield=["in_file"], name="despiker",
+        afni.Despike(outputtype=output_type), iterfield=["in_file"], name="despiker",
     )
 
     realign_runs = pe.MapNode(
-        fsl.MCFLIRT(output_type="NIFTI_GZ", interpolation="sinc"),
+        fsl.MCFLIRT(output_type=output_type, interpolation="sinc"),
         iterfield=["in_file", "ref_file"],
         name="func_realign",
     )
@@ -110,27 +136,42 @@ def fsl_run_level_wf(
         name=f"model_{level}_generate",
     )
 
-    estimate_model = pe.MapNode(
-        fsl.FILMGLS(
-            threshold=0.0,  # smooth_autocorr=True
-            output_type="NIFTI_GZ",
-            results_dir="results",
-            smooth_autocorr=False,
-            autocorr_noestimate=True,
-        ),
-        iterfield=["design_file", "in_file", "tcon_file"],
-        name=f"model_{level}_estimate",
+    generate_design = pe.MapNode(
+        GenerateRunDesign(),
+        iterfield=["run_info", "contrasts", "repetition_time", "functional_file"],
+        name=f"model_{level}_generate",
     )
 
+    if engine == "native":
+        estimate_model = pe.MapNode(
+            EstimateRunModel(results_dir="results", output_type=output_type),
+            iterfield=["design_file", "in_file", "tcon_file", "mask_file"],
+            name=f"model_{level}_estimate",
+        )
+    else:
+        estimate_model = pe.MapNode(
+            fsl.FILMGLS(
+                threshold=0.0,  # smooth_autocorr=True
+                output_type=output_type,
+                results_dir="results",
+                smooth_autocorr=False,
+                autocorr_noestimate=True,
+            ),
+            iterfield=["design_file", "in_file", "tcon_file"],
+            name=f"model_{level}_estimate",
+        )
+
     if smooth_autocorrelations:
         first_level_design.inputs.model_serial_correlations = True
-        estimate_model.inputs.smooth_autocorr = True
-        estimate_model.inputs.autocorr_noestimate = False
+        if engine == "native":
+            estimate_model.inputs.autocorr_model = "tukey"
+            estimate_model.inputs.smooth_autocorr = True
+        else:
+            estimate_model.inputs.smooth_autocorr = True
+            estimate_model.inputs.autocorr_noestimate = False
 
-    calculate_p = pe.MapNode(
-        fsl.ImageMaths(output_type="NIFTI_GZ", op_string="-ztop", suffix="_pval"),
-        iterfield=["in_file"],
-        name=f"model_{level}_caculate_p",
+    calculate_p = pe.Node(
+        ConvertZToP(output_type=output_type), name=f"model_{level}_caculate_p"
     )
 
     image_pattern = (
@@ -156,6 +197,18 @@ def fsl_run_level_wf(
         name="rapidart_run",
     )
 
+    detect_outliers = pe.MapNode(
+        DetectOutliers(cache_dir=str(confounds_cache)),
+        iterfield=[
+            "functional_file",
+            "mask_file",
+            "regressor_file",
+            "run_info",
+            "contrast_entities",
+        ],
+        name="rapidart_run",
+    )
+
     reshape_rapidart = pe.MapNode(
         Function(
             input_names=["run_info", "functional_file", "outlier_file", "contrast_entities"],
@@ -166,29 +219,44 @@ def fsl_run_level_wf(
         name="reshape_rapidart",
     )
 
-    mean_img = pe.MapNode(
-        fsl.ImageMaths(output_type="NIFTI_GZ", op_string="-Tmean", suffix="_mean"),
+    run_iso = pe.MapNode(
+        IsotropicSmooth(num_threads=4, output_type=output_type),
         iterfield=["in_file", "mask_file"],
-        name="smooth_susan_avgimg",
+        n_procs=4,
+        name="smooth_iso",
     )
 
-    median_img = pe.MapNode(
-        fsl.ImageStats(output_type="NIFTI_GZ", op_string="-k %s -p 50"),
+    susan_stats = pe.MapNode(
+        SusanStatistics(output_type=output_type),
         iterfield=["in_file", "mask_file"],
-        name="smooth_susan_medimg",
+        name="smooth_susan_stats",
     )
 
     merge = pe.Node(Merge(2, axis="hstack"), name="smooth_merge")
 
-    run_susan = pe.MapNode(
-        fsl.SUSAN(output_type="NIFTI_GZ"),
-        iterfield=["in_file", "brightness_threshold", "usans"],
-        name="smooth_susan",
-    )
+    if engine == "native":
+        run_susan = pe.MapNode(
+            SusanSmooth(output_type=output_type),
+            iterfield=["in_file", "brightness_threshold", "usans"],
+            name="smooth_susan",
+        )
+    else:
+        run_susan = pe.MapNode(
+            fsl.SUSAN(output_type=output_type),
+            iterfield=["in_file", "brightness_threshold", "usans"],
+            name="smooth_susan",
+        )
 
-    mask_functional = pe.MapNode(
-        ApplyMask(), iterfield=["in_file", "mask_file"], name="mask_functional"
-    )
+    if engine == "native":
+        mask_functional = pe.MapNode(
+            MaskTimeseries(), iterfield=["in_file", "mask_file"], name="mask_functional"
+        )
+    else:
+        mask_functional = pe.MapNode(
+            ApplyMask(output_type=output_type),
+            iterfield=["in_file", "mask_file"],
+            name="mask_functional",
+        )
 
     # Exists solely to correct undesirable behavior of FSL
     # that results in loss of constant columns
@@ -233,7 +301,7 @@ def fsl_run_level_wf(
     )
 
     plot_matrices = pe.MapNode(
-        PlotMatrices(output_dir=output_dir, database_path=database_path),
+        PlotMatrices(output_dir=output_dir),
         iterfield=["mat_file", "con_file", "entities", "run_info"],
         run_without_submitting=True,
         name=f"plot_{level}_matrices",
@@ -297,7 +365,27 @@ def fsl_run_level_wf(
     else:
         workflow.connect([(getter, wrangle_volumes, [("functional_files", "functional_file")])])
 
-    if use_rapidart:
+    if use_rapidart and engine == "native":
+        model_info = detect_outliers
+        workflow.connect(
+            [
+                (
+                    getter,
+                    detect_outliers,
+                    [("mask_files", "mask_file"), ("regressor_files", "regressor_file")],
+                ),
+                (wrangle_volumes, detect_outliers, [("functional_file", "functional_file")]),
+                (
+                    get_info,
+                    detect_outliers,
+                    [("run_info", "run_info"), ("contrast_entities", "contrast_entities")],
+                ),
+                (detect_outliers, plot_matrices, [("run_info", "run_info")]),
+                (detect_outliers, collate, [("contrast_entities", "contrast_metadata")]),
+            ]
+        )
+    elif use_rapidart:
+        model_info = reshape_rapidart
         workflow.connect(
             [
                 (get_info, run_rapidart, [("motion_parameters", "realignment_parameters")]),
@@ -310,43 +398,55 @@ def fsl_run_level_wf(
                     [("run_info", "run_info"), ("contrast_entities", "contrast_entities")],
                 ),
                 (wrangle_volumes, reshape_rapidart, [("functional_file", "functional_file")]),
-                (reshape_rapidart, specify_model, [("run_info", "subject_info")],),
                 (reshape_rapidart, plot_matrices, [("run_info", "run_info")]),
                 (reshape_rapidart, collate, [("contrast_entities", "contrast_metadata")]),
             ]
         )
     else:
+        model_info = get_info
         workflow.connect(
             [
-                (get_info, specify_model, [("run_info", "subject_info")]),
                 (get_info, plot_matrices, [("run_info", "run_info")]),
                 (get_info, collate, [("contrast_entities", "contrast_metadata")],),
             ]
         )
 
     if smoothing_level == "l1" or smoothing_level == "run":
-        run_susan.inputs.fwhm = smoothing_fwhm
-        run_susan.inputs.dimension = dimensionality
-        estimate_model.inputs.mask_size = smoothing_fwhm
+        if engine == "native":
+            estimate_model.inputs.autocorr_fwhm = smoothing_fwhm
+        else:
+            estimate_model.inputs.mask_size = smoothing_fwhm
+        if smoothing_type == "iso":
+            run_smoothing = run_iso
+            run_iso.inputs.fwhm = smoothing_fwhm
+            workflow.connect(
+                [
+                    (wrangle_volumes, run_iso, [("functional_file", "in_file")]),
+                    (getter, run_iso, [("mask_files", "mask_file")]),
+                ]
+            )
+        else:
+            run_smoothing = run_susan
+            run_susan.inputs.fwhm = smoothing_fwhm
+            run_susan.inputs.dimension = dimensionality
+            workflow.connect(
+                [
+                    (wrangle_volumes, susan_stats, [("functional_file", "in_file")]),
+                    (getter, susan_stats, [("mask_files", "mask_file")]),
+                    (susan_stats, merge, [("mean_file", "in1"), ("median_value", "in2")]),
+                    (wrangle_volumes, run_susan, [("functional_file", "in_file")]),
+                    (
+                        susan_stats,
+                        run_susan,
+                        [(("median_value", utils.get_btthresh), "brightness_threshold",)],
+                    ),
+                    (merge, run_susan, [(("out", utils.get_usans), "usans")]),
+                ]
+            )
         workflow.connect(
             [
-                (wrangle_volumes, mean_img, [("functional_file", "in_file")]),
-                (wrangle_volumes, median_img, [("functional_file", "in_file")],),
-                (getter, mean_img, [("mask_files", "mask_file")]),
-                (getter, median_img, [("mask_files", "mask_file")]),
-                (mean_img, merge, [("out_file", "in1")]),
-                (median_img, merge, [("out_stat", "in2")]),
-                (wrangle_volumes, run_susan, [("functional_file", "in_file")]),
-                (
-                    median_img,
-                    run_susan,
-                    [(("out_stat", utils.get_btthresh), "brightness_threshold",)],
-                ),
-                (merge, run_susan, [(("out", utils.get_usans), "usans")]),
                 (getter, mask_functional, [("mask_files", "mask_file")]),
-                (run_susan, mask_functional, [("smoothed_file", "in_file")]),
-                (mask_functional, specify_model, [("out_file", "functional_runs")],),
-                (mask_functional, fit_model, [("out_file", "functional_data")],),
+                (run_smoothing, mask_functional, [("smoothed_file", "in_file")]),
             ]
         )
 
@@ -355,58 +455,83 @@ def fsl_run_level_wf(
             [
                 (getter, mask_functional, [("mask_files", "mask_file")]),
                 (wrangle_volumes, mask_functional, [("functional_file", "in_file")],),
-                (mask_functional, specify_model, [("out_file", "functional_runs")],),
-                (mask_functional, fit_model, [("out_file", "functional_data")],),
             ]
         )
 
-    workflow.connect(
-        [
-            (get_info, specify_model, [("repetition_time", "time_repetition")],),
-            (specify_model, fit_model, [("session_info", "session_info")]),
-            (
-                get_info,
-                fit_model,
-                [("repetition_time", "interscan_interval"), ("run_contrasts", "contrasts")],
-            ),
-            (
-                fit_model,
-                first_level_design,
-                [
-                    ("interscan_interval", "interscan_interval"),
-                    ("session_info", "session_info"),
-                    ("contrasts", "contrasts"),
-                ],
-            ),
-            (first_level_design, generate_model, [("fsf_files", "fsf_file")]),
-            (first_level_design, generate_model, [("ev_files", "ev_files")]),
-        ]
-    )
-
-    if detrend_poly:
+    if engine == "native":
         workflow.connect(
             [
-                (generate_model, correct_matrices, [("design_file", "design_matrix")],),
-                (correct_matrices, plot_matrices, [("design_matrix", "mat_file")],),
-                (correct_matrices, estimate_model, [("design_matrix", "design_file")],),
+                (model_info, generate_design, [("run_info", "run_info")]),
+                (
+                    get_info,
+                    generate_design,
+                    [("repetition_time", "repetition_time"), ("run_contrasts", "contrasts")],
+                ),
+                (wrangle_volumes, generate_design, [("functional_file", "functional_file")]),
+                (
+                    generate_design,
+                    plot_matrices,
+                    [("design_file", "mat_file"), ("con_file", "con_file")],
+                ),
+                (
+                    generate_design,
+                    estimate_model,
+                    [("design_file", "design_file"), ("con_file", "tcon_file")],
+                ),
+                (getter, estimate_model, [("mask_files", "mask_file")]),
+                (mask_functional, estimate_model, [("out_file", "in_file")]),
             ]
         )
-
     else:
         workflow.connect(
             [
-                (generate_model, plot_matrices, [("design_file", "mat_file")]),
-                (generate_model, estimate_model, [("design_file", "design_file")],),
+                (model_info, specify_model, [("run_info", "subject_info")]),
+                (mask_functional, specify_model, [("out_file", "functional_runs")]),
+                (mask_functional, fit_model, [("out_file", "functional_data")]),
+                (get_info, specify_model, [("repetition_time", "time_repetition")],),
+                (specify_model, fit_model, [("session_info", "session_info")]),
+                (
+                    get_info,
+                    fit_model,
+                    [("repetition_time", "interscan_interval"), ("run_contrasts", "contrasts")],
+                ),
+                (
+                    fit_model,
+                    first_level_design,
+                    [
+                        ("interscan_interval", "interscan_interval"),
+                        ("session_info", "session_info"),
+                        ("contrasts", "contrasts"),
+                    ],
+                ),
+                (first_level_design, generate_model, [("fsf_files", "fsf_file")]),
+                (first_level_design, generate_model, [("ev_files", "ev_files")]),
+                (generate_model, plot_matrices, [("con_file", "con_file")]),
+                (fit_model, estimate_model, [("functional_data", "in_file")]),
+                (generate_model, estimate_model, [("con_file", "tcon_file")]),
             ]
         )
 
+        if detrend_poly:
+            workflow.connect(
+                [
+                    (generate_model, correct_matrices, [("design_file", "design_matrix")],),
+                    (correct_matrices, plot_matrices, [("design_matrix", "mat_file")],),
+                    (correct_matrices, estimate_model, [("design_matrix", "design_file")],),
+                ]
+            )
+
+        else:
+            workflow.connect(
+                [
+                    (generate_model, plot_matrices, [("design_file", "mat_file")]),
+                    (generate_model, estimate_model, [("design_file", "design_file")],),
+                ]
+            )
+
     workflow.connect(
         [
             (getter, plot_matrices, [("entities", "entities")]),
-            (generate_model, plot_matrices, [("con_file", "con_file")]),
-            (fit_model, estimate_model, [("functional_data", "in_file")]),
-            (generate_model, estimate_model, [("con_file", "tcon_file")]),
-            (estimate_model, calculate_p, [(("zstats", utils.flatten), "in_file")],),
             (
                 estimate_model,
                 collate,
@@ -417,7 +542,6 @@ def fsl_run_level_wf(
                     ("tstats", "tstat_maps"),
                 ],
             ),
-            (calculate_p, collate, [("out_file", "pvalue_maps")]),
             (
                 collate,
                 collate_outputs,
@@ -439,6 +563,16 @@ def fsl_run_level_wf(
         ]
     )
 
+    if engine == "native":
+        workflow.connect([(estimate_model, collate, [("pvals", "pvalue_maps")])])
+    else:
+        workflow.connect(
+            [
+                (estimate_model, calculate_p, [(("zstats", utils.flatten), "in_files")]),
+                (calculate_p, collate, [("out_files", "pvalue_maps")]),
+            ]
+        )
+
     return workflow
 
 
@@ -451,6 +585,8 @@ def fsl_higher_level_wf(
     smoothing_type=None,
     align_volumes=None,
     smoothing_level=None,
+    engine="fsl",
+    uncompressed_work=False,
     name="fsl_higher_level_wf",
 ):
     """
@@ -459,7 +595,8 @@ def fsl_higher_level_wf(
     This workflow generates processes functional_data across a
     single session (read: between runs) and computes
     effects, variances, residuals and statmaps
-    using FSLs FLAME0 given information in the bids model file
+    using FSLs FLAME0 (or the native fixed effects estimator when
+    ``engine="native"``) given information in the bids model file
     """
     workflow = pe.Workflow(name=name)
     workflow.base_dir = work_dir
@@ -467,6 +604,7 @@ def fsl_higher_level_wf(
 
     # layout = BIDSLayout.load(database_path)
     level = step["Level"]
+    output_type = "NIFTI" if uncompressed_work else "NIFTI_GZ"
 
     image_pattern = (
         "[sub-{subject}/][ses-{session}/]"
@@ -482,7 +620,15 @@ def fsl_higher_level_wf(
     )
 
     get_info = pe.Node(
-        GenerateHigherInfo(model=step, database_path=database_path, align_volumes=align_volumes,),
+        GenerateHigherInfo(
+            model=step,
+            database_path=database_path,
+            align_volumes=align_volumes,
+            merge_maps=engine == "fsl",
+            output_type=output_type,
+        ),
+        # Only grouping maps is light enough to share the main process and its cached layout
+        run_without_submitting=engine != "fsl",
         name=f"get_{level}_info",
     )
 
@@ -491,24 +637,29 @@ def fsl_higher_level_wf(
         smoothing_type
         pass
 
-    estimate_model = pe.MapNode(
-        fsl.FLAMEO(output_type="NIFTI_GZ", run_mode="fe"),
-        iterfield=[
-            "design_file",
-            "t_con_file",
-            "mask_file",
-            "cov_split_file",
-            "dof_var_cope_file",
-            "var_cope_file",
-            "cope_file",
-        ],
-        name=f"model_{level}_estimate",
-    )
+    if engine == "native":
+        estimate_model = pe.MapNode(
+            EstimateFixedEffects(output_type=output_type),
+            iterfield=["effect_maps", "variance_maps", "dof_values", "mask_file"],
+            name=f"model_{level}_estimate",
+        )
+    else:
+        estimate_model = pe.MapNode(
+            fsl.FLAMEO(output_type=output_type, run_mode="fe"),
+            iterfield=[
+                "design_file",
+                "t_con_file",
+                "mask_file",
+                "cov_split_file",
+                "dof_var_cope_file",
+                "var_cope_file",
+                "cope_file",
+            ],
+            name=f"model_{level}_estimate",
+        )
 
-    calculate_p = pe.MapNode(
-        fsl.ImageMaths(output_type="NIFTI_GZ", op_string="-ztop", suffix="_pval"),
-        iterfield=["in_file"],
-        name=f"model_{level}_caculate_p",
+    calculate_p = pe.Node(
+        ConvertZToP(output_type=output_type), name=f"model_{level}_caculate_p"
     )
 
     collate = pe.Node(
@@ -552,6 +703,43 @@ def fsl_higher_level_wf(
         name=f"wrangle_{level}_outputs",
     )
 
+    if engine == "native":
+        workflow.connect(
+            [
+                (
+                    get_info,
+                    estimate_model,
+                    [
+                        ("grouped_effect_maps", "effect_maps"),
+                        ("grouped_variance_maps", "variance_maps"),
+                        ("grouped_dofs", "dof_values"),
+                        ("brain_mask", "mask_file"),
+                    ],
+                ),
+                (estimate_model, collate, [("pvals", "pvalue_maps")]),
+            ]
+        )
+    else:
+        workflow.connect(
+            [
+                (
+                    get_info,
+                    estimate_model,
+                    [
+                        ("design_matrices", "design_file"),
+                        ("contrast_matrices", "t_con_file"),
+                        ("covariance_matrices", "cov_split_file"),
+                        ("dof_maps", "dof_var_cope_file"),
+                        ("variance_maps", "var_cope_file"),
+                        ("effect_maps", "cope_file"),
+                        ("brain_mask", "mask_file"),
+                    ],
+                ),
+                (estimate_model, calculate_p, [("zstats", "in_files")]),
+                (calculate_p, collate, [("out_files", "pvalue_maps")]),
+            ]
+        )
+
     workflow.connect(
         [
             (
@@ -559,20 +747,6 @@ def fsl_higher_level_wf(
                 get_info,
                 [("contrast_metadata", "contrast_metadata"), ("contrast_maps", "contrast_maps")],
             ),
-            (
-                get_info,
-                estimate_model,
-                [
-                    ("design_matrices", "design_file"),
-                    ("contrast_matrices", "t_con_file"),
-                    ("covariance_matrices", "cov_split_file"),
-                    ("dof_maps", "dof_var_cope_file"),
-                    ("variance_maps", "var_cope_file"),
-                    ("effect_maps", "cope_file"),
-                    ("brain_mask", "mask_file"),
-                ],
-            ),
-            (estimate_model, calculate_p, [("zstats", "in_file")]),
             (
                 estimate_model,
                 collate,
@@ -583,7 +757,6 @@ def fsl_higher_level_wf(
                     ("tstats", "tstat_maps"),
                 ],
             ),
-            (calculate_p, collate, [("out_file", "pvalue_maps")]),
             (get_info, collate, [("contrast_metadata", "contrast_metadata")]),
             (
                 collate,